@@ -1,27 +1,40 @@
 import pygame
 from version_3_backend import Backend
 from version_3_widgets import *
+from version_3_simulation import DIMENSIONS, SIZE, PELLET_SIZE, SPEED, LEFT, RIGHT, UP, DOWN, MAZES, PelletGrid, \
+    WallGrid, spawn_point
+import version_3_maze
+from version_3_interpolation import SnapshotBuffer
 
 # Initialise Pygame modules
 pygame.init()
 
-# Game constants (pixels)
-DIMENSIONS = (510, 500)                                         # Dimensions of the game window
-SIZE = 30                                                       # Length of each grid
-PELLET_SIZE = 10                                                # Length of each pellet
-
 # Game initialisation
 screen = pygame.display.set_mode(DIMENSIONS)                    # Create the window
 screen.fill(BACKGROUND_COLOR)                                   # Set the initial colour
 pygame.display.set_caption("Pacman")                            # Set the title
 
-backend = Backend()                                             # Create the backend and the socket 
-
 clock = pygame.time.Clock()                                     # Create a Clock object
 FPS = 60                                                        # The framerate constant
+HEARTBEAT = 1000                                                # Milliseconds between coordinate updates when standing still
+UDP = True                                                      # Send coordinates over UDP if the server offers it
+INTERPOLATION_DELAY = 50                                        # Milliseconds the other player is drawn behind
+MAX_EXTRAPOLATION = 250                                         # Milliseconds the other player keeps moving when data is late
+SHOW_LATENCY = True                                             # Show the round trip time to the server next to the score
+MAZE_CACHE = None                                               # Folder to save compiled mazes in, None keeps them in memory only
+
+backend = Backend(UDP)                                          # Create the backend and the socket 
 
 controlling_pacman = None
 
+# Bits sent to the server for each held arrow key in authoritative mode.
+INPUT_BITS = {
+    pygame.K_LEFT: LEFT,
+    pygame.K_RIGHT: RIGHT,
+    pygame.K_UP: UP,
+    pygame.K_DOWN: DOWN
+}
+
 
 class Placeable(pygame.sprite.Sprite):
 
@@ -44,28 +57,49 @@ class Placeable(pygame.sprite.Sprite):
         Placeable.all_group.add(self)
 
 
-class Wall(Placeable):
+class Wall(object):
 
-    wall_group = pygame.sprite.Group()
+    grid = WallGrid()                                           # The tiles that hold a wall, for collisions
+    background = None                                           # The level's walls drawn on the background colour
+    backgrounds = {}                                            # Drawn background of each compiled maze
 
-    def __init__(self, x, y, size: tuple, color: tuple):
-        super().__init__(x, y, size, color)                     # Create a placeable object
+    @staticmethod
+    def load(maze):
+        # Use the walls of a compiled maze. Walls never move, so each maze is only drawn once.
+        Wall.grid = WallGrid(maze)
 
-    def _add_to_groups(self):
-        super()._add_to_groups()                                # Add to the collective sprite container
-        Wall.wall_group.add(self)                               # Add to the wall sprite container
+        background = Wall.backgrounds.get(maze)
+        if background is None:
+            background = pygame.Surface(DIMENSIONS).convert()
+            background.fill(BACKGROUND_COLOR)
+            for col, row in maze.wall_tiles():
+                background.fill(BLACK, (col*SIZE, row*SIZE, SIZE, SIZE))
+            Wall.backgrounds[maze] = background
 
+        Wall.background = background
 
-class Pellet(Placeable):
-    
-    pellet_group = pygame.sprite.Group()
+    @staticmethod
+    def unload():
+        Wall.grid = WallGrid()
+        Wall.background = None
 
-    def __init__(self, x, y, size: tuple, color: tuple):
-        super().__init__(x, y, size, color)                     # Create a placeable object
+
+class Pellet(object):
     
-    def _add_to_groups(self):
-        super()._add_to_groups()                                # Add to the collective sprite container
-        Pellet.pellet_group.add(self)                           # Add to the wall sprite container
+    grid = PelletGrid()                                         # The tiles that still hold a pellet
+    eaten = []                                                  # Rects of the pellets eaten since the last frame
+    image = pygame.Surface((PELLET_SIZE, PELLET_SIZE))          # One image shared by every pellet
+    image.fill(ORANGE)
+
+    @staticmethod
+    def eat(rect):
+        # Removes the pellets under a rect and returns how many there were.
+        return Pellet.grid.eat(rect, Pellet.eaten)
+
+    @staticmethod
+    def draw(target_surface, rect=None):
+        # Draw every pellet that is left, or only those under a rect.
+        target_surface.blits([(Pellet.image, position) for position in Pellet.grid.positions(rect)], False)
 
 
 class Playable(Placeable):
@@ -98,14 +132,14 @@ class Playable(Placeable):
             for key in directions:
                 if keys[key]:                                                                       # Arrow key is pressed
                     new_position = self.rect.move(directions[key])                                  # Find new coordinates
-                    if not any(wall.rect.colliderect(new_position) for wall in Wall.wall_group):    # No wall collisions
+                    if not Wall.grid.collides(new_position):                                        # No wall collisions
                         self.rect = new_position                                                    # Update coordinates
                         self.last_key = key
                         break
             else:                                                                                   # No arrow key is pressed
                 if self.last_key:                                                                 # Validation for initial state being falsy
                     new_position = self.rect.move(directions[self.last_key])                      # Find coordinates if moved in last directon
-                    if not any (wall.rect.colliderect(new_position) for wall in Wall.wall_group):   # No wall collisions
+                    if not Wall.grid.collides(new_position):                                    # No wall collisions
                         self.rect = new_position                                                    # Update coordinates
     
     def __check_for_teleport(self):
@@ -138,21 +172,19 @@ class Pacman(Playable):
         super()._add_to_groups()                                # Add to the collective container
         Pacman.pacman_group.add(self)                           # Add to the pacman container
     
-    def pellet_checker(self):
-        # Get an array of pellet objects that have collided with Pacman and then remove them from pellet_group.
-        collided_pellets = pygame.sprite.spritecollide(self, Pellet.pellet_group, True)
-
-        # Increase the score by one per pellet
-        if collided_pellets:
-            for pellet in collided_pellets:
-                self.score += 1                                        
-                Placeable.all_group.remove(pellet)
+    def pellet_checker(self, rect=None):
+        # Checks the given rect, or Pacman's rect if no rect is given.
+        rect = self.rect if rect is None else pygame.Rect(rect)
+
+        # Remove the pellets that have collided with Pacman and increase the score by one per pellet.
+        self.score += Pellet.eat(rect)
     
-    def has_ghost_eaten_pacman(self):
-        # Checks if a Ghost sprite is colliding with the Pacman sprite.
+    def has_ghost_eaten_pacman(self, ghost_rect=None, rect=None):
+        # Checks if a Ghost is colliding with Pacman, using the given rects or else the sprites' rects.
         # Returns true if the Ghost has eaten Pacman.
-        collision = pygame.sprite.spritecollide(self, Ghost.ghost_group, False)
-        return True if collision else False
+        rect = self.rect if rect is None else rect
+        ghost_rects = [ghost.rect for ghost in Ghost.ghost_group] if ghost_rect is None else [ghost_rect]
+        return rect.collidelist(ghost_rects) != -1
     
     def main(self):
         super().main()
@@ -276,6 +308,34 @@ class Port(Page):
         self.input.text = ""
 
 
+class Room(Page):
+    def __init__(self):
+        # Create the widgets.
+        self.title = Text(25, 50, "Enter Room", 48)
+        self.input = Input(25, 200, 48)
+        self.submit = Button(25, 300, "Submit", 48, BLACK)
+        self.widgets = [self.title, self.input, self.submit]
+
+    def event_handler(self, event):
+        # Keyboard input is handled by the input object.
+        if event.type == pygame.KEYDOWN:
+            self.input.handle_input(event)
+
+        # Left mouse button click on the submit button.
+        elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+            if self.submit.rect.collidepoint(event.pos):
+                # Join the room, both players must enter the same room name.
+                # An empty name joins the default room.
+                backend.send("join-room", self.input.text)
+                # Reset page for next time.
+                self.reset_input()
+                self.next_page()
+
+    def reset_input(self):
+        # Empty the room input.
+        self.input.text = ""
+
+
 class Interim(Page):
     def __init__(self):
         # Create the widgets.
@@ -285,21 +345,24 @@ class Interim(Page):
     
     def update(self, target_surface):
         # Update the widgets.
-        super().update(target_surface)
+        dirty = super().update(target_surface)
 
         if not self.lobby_load_request_sent:
             # Send an load request.
             backend.send("lobby-load-request", "_")
             self.lobby_load_request_sent = True
         
-        packet = backend.receive()
-        if packet:
-            header = packet[0]
+        # Handle every message that has arrived since the last frame.
+        messages = backend.receive_all()
+        for index, (header, payload) in enumerate(messages):
 
             # When all players are at the Interim page.
             if header == "lobby-load-granted":   
                 self.lobby_load_request_sent = False
                 self.next_page()
+                # The rest of the messages are for the Lobby page.
+                backend.put_back(messages[index + 1:])
+                return dirty
             
             # A player has disconnected from the server.
             elif header == "disconnect":
@@ -308,7 +371,18 @@ class Interim(Page):
                 # Change to the start page.
                 self.change_page(0)
                 # Update the title to inform the player.
-                pages[0].change_title("Player disconnected")
+                pages[0].change_title("Server disconnected" if payload == "server" else "Player disconnected")
+                return dirty
+
+            # The room already has two players.
+            elif header == "room-full":
+                self.lobby_load_request_sent = False
+                backend.disconnect()
+                self.change_page(0)
+                pages[0].change_title("Room full")
+                return dirty
+
+        return dirty
 
 
 class Lobby(Page):
@@ -348,23 +422,28 @@ class Lobby(Page):
         
     def update(self, target_surface):
         # Update page. Draw widgets.
-        super().update(target_surface)
+        dirty = super().update(target_surface)
         
-        backend.send("game-load-request", "_")
-        packet = backend.receive()
-        if packet:
-            header = packet[0]
+        # Handle every message that has arrived since the last frame.
+        messages = backend.receive_all()
+        for index, (header, payload) in enumerate(messages):
             # Other player has selected the Pacman button.
             if header == "pacman-selected":
+                if self.local_button_active and controlling_pacman:
+                    # Both players picked Pacman, the other player was first. Pick the Ghost instead.
+                    self.local_button_active = False
                 self.pacman.background_colour = RED
                 self.pacman.active = True
             
             # Other player has selected the Ghost button.
             elif header == "ghost-selected":
+                if self.local_button_active and not controlling_pacman:
+                    # Both players picked the Ghost, the other player was first. Pick Pacman instead.
+                    self.local_button_active = False
                 self.ghost.background_colour = RED
                 self.ghost.active = True
             
-            # Both players have selected a character.
+            # Both players have selected a character, the server starts the game.
             elif header == "start-game":
                 # Reset the page
                 self.pacman.background_colour = BLACK
@@ -374,10 +453,15 @@ class Lobby(Page):
                 self.local_button_active = False
 
                 # Update the player label depending on what character button is pressed.
-                pages[5].update_player_label_text()
+                pages[6].update_player_label_text()
+                # The server tells the clients if it is running the game.
+                pages[6].authoritative = bool(payload)
                 # Play the intro music.
                 self.intro_music.play()
                 self.next_page()
+                # The rest of the messages are for the Game page.
+                backend.put_back(messages[index + 1:])
+                return dirty
 
             # A player has disconnected from the server.
             elif header == "disconnect":
@@ -386,56 +470,74 @@ class Lobby(Page):
                 # Change to the start page.
                 self.change_page(0)
                 # Update the title to inform the player.
-                pages[0].change_title("Player disconnected")
+                pages[0].change_title("Server disconnected" if payload == "server" else "Player disconnected")
+                return dirty
+
+        return dirty
 
 
 class Game(Page):
     def __init__(self):
         self.maze_number = 0
+        self.loaded_maze = None
+
+        # In authoritative mode the server moves both sprites, the client sends its arrow keys.
+        self.authoritative = False
+        self.sent_keys = None
+
+        # The last coordinates sent to the other player and when they were sent.
+        self.sent_position = None
+        self.sent_time = 0
+
+        # The pellet grid the page was last drawn with, a new level gets a new grid and is drawn in full.
+        self.drawn_pellets = None
+
+        # Received coordinates of the other player, drawn smoothly a little behind.
+        self.remote = SnapshotBuffer(INTERPOLATION_DELAY, MAX_EXTRAPOLATION, SPEED * FPS / 1000, SIZE)
+        # The last received rect of the other player, where it really is. The game over check uses it.
+        self.remote_rect = None
         
-        # Create the game objects.
+        # Create the game objects, the maze moves the players to its spawn points.
+        self.pacman = Pacman(*spawn_point(version_3_maze.PACMAN_SPAWN), (SIZE, SIZE), YELLOW, SPEED)
+        self.ghost = Ghost(*spawn_point(version_3_maze.GHOST_SPAWN), (SIZE, SIZE), RED, SPEED)
         self.create_maze()
-        self.pacman = Pacman(30, 30, (SIZE, SIZE), YELLOW, 2)
-        self.ghost = Ghost(450, 240, (SIZE, SIZE), RED, 2)
         
         # Create the widgets.
         self.score_label = Text(50,300,"Score = 0", 48)
         self.player_label = Text(50, 350, "Playing as ?", 48)
         self.mute_button = Button(50, 400, "Mute", 48, GREEN)
         self.mute = False
+        self.latency_label = Text(330, 310, "Ping ?", 32)
         self.widgets = [self.score_label, self.player_label, self.mute_button]
+        if SHOW_LATENCY:
+            self.widgets.append(self.latency_label)
 
         # Load the sound effects.
         self.death_sound_effect = pygame.mixer.Sound("death.wav")
         self.victory = pygame.mixer.Sound("victory.wav")
 
-    def create_maze(self):
-        mazes = ["maze1.txt", "maze2.txt", "maze3.txt"]
+    def create_maze(self, maze_number=None):
         '''
-        Creates wall and pellet objects from a file template.
-        The position of each character in the file is used to determine its grid coordinates.
-        The object that the character represents is created and placed at its grid coordinates.
-        Key:
-            "x" = wall
-            "o" = pellet
+        Loads the walls and the pellet grid from a compiled maze.
+        Each file is only parsed the first time it is loaded, see version_3_maze.py.
+        Loads the next maze, unless a maze number is given.
         '''
-        # Open the file that contains the maze data.
-        with open(mazes[self.maze_number], "r") as f:
-            # Iterate over each line of the file.
-            for row, line in enumerate(f):
-                # Iterate over each character in the line.
-                for col, char in enumerate(line):
-                    if char == "x": 
-                        # Create a Wall object.
-                        Wall(col*SIZE, row*SIZE, (SIZE, SIZE), BLACK)
-                    elif char == "o":
-                        # Create a Pellet object.
-                        Pellet(col*SIZE+PELLET_SIZE, row*SIZE+PELLET_SIZE, (PELLET_SIZE, PELLET_SIZE), ORANGE)
-                    else:
-                        # Create an empty grid.
-                        pass
-        
-        if self.maze_number == len(mazes) - 1:
+        if maze_number is not None:
+            self.maze_number = maze_number
+        self.loaded_maze = self.maze_number
+
+        # Load the compiled maze.
+        maze = version_3_maze.load(MAZES[self.maze_number], MAZE_CACHE)
+        Wall.load(maze)
+        Pellet.grid = PelletGrid(maze)
+
+        # Move the players to the maze's spawn points.
+        self.pacman.spawn = spawn_point(maze.pacman_spawn)
+        self.ghost.spawn = spawn_point(maze.ghost_spawn)
+        self.pacman.move_to_spawn()
+        self.ghost.move_to_spawn()
+
+        if self.maze_number == len(MAZES) - 1:
             # Go back to the first maze.
             self.maze_number = 0
         else:
@@ -450,43 +552,120 @@ class Game(Page):
         else:
             self.player_label.text = "Controlling Ghost"
 
+    def send_input(self):
+        # Sends the held arrow keys to the server when they change.
+        keys = pygame.key.get_pressed()
+        held = 0
+        for key, bit in INPUT_BITS.items():
+            if keys[key]:
+                held |= bit
+
+        if held != self.sent_keys:
+            backend.send("input", held)
+            self.sent_keys = held
+
+    def apply_snapshot(self, snapshot):
+        # Draws the match as the server simulated it.
+        tick, maze_number, pacman_x, pacman_y, ghost_x, ghost_y, score = snapshot
+
+        if maze_number != self.loaded_maze or Wall.background is None:
+            if Wall.background is not None:
+                # Pacman has eaten every pellet.
+                self.victory.play()
+            self.reset()
+            self.create_maze(maze_number)
+
+        self.pacman.rect[:2] = (pacman_x, pacman_y)
+        self.ghost.rect[:2] = (ghost_x, ghost_y)
+        # Remove the pellets Pacman has eaten from the screen, the server keeps the score.
+        self.pacman.pellet_checker()
+        self.pacman.score = score
+
+    def move_remote_sprite(self, now):
+        # Moves the other player's sprite to its smoothed position.
+        position = self.remote.sample(now)
+        if position is None:
+            return
+
+        position, extrapolated = position
+        sprite = self.ghost if controlling_pacman else self.pacman
+        new_position = sprite.rect.copy()
+        new_position.topleft = position
+
+        # A guessed position must not go through a wall.
+        if extrapolated and Wall.grid.collides(new_position):
+            return
+
+        sprite.rect = new_position
+
+    def has_ghost_eaten_pacman(self):
+        # Checks this player's sprite against where the other player really is, not where it is drawn.
+        # The drawn sprite is a little behind, or guessed ahead when the messages are late.
+        if self.remote_rect is None:
+            return False
+
+        if controlling_pacman:
+            return self.pacman.has_ghost_eaten_pacman(self.remote_rect)
+        return self.pacman.has_ghost_eaten_pacman(self.ghost.rect, self.remote_rect)
+
     def update(self, target_surface):
         global controlling_pacman
-        
-        # Move sprite in control.
-        (self.pacman if controlling_pacman else self.ghost).main()
 
-        # Send coordinates to other player.
-        header = "pacman-coordinates" if controlling_pacman else "ghost-coordinates"
-        payload = tuple(self.pacman.rect[:2]) if controlling_pacman else tuple(self.ghost.rect[:2])
-        backend.send(header, payload)
+        # Where the sprites were drawn, to cover them if they move.
+        drawn_rects = [sprite.rect.copy() for sprite in Placeable.all_group]
+        
+        if self.authoritative:
+            self.send_input()
 
-        # Receive coordinates.
-        packet = backend.receive()
-        if packet:
-            header, payload = packet[0], packet[1]
+        else:
+            # Move sprite in control.
+            (self.pacman if controlling_pacman else self.ghost).main()
+
+            # Send coordinates to other player, only if they changed or the heartbeat is due.
+            # The other player keeps showing the last coordinates it received.
+            header = "pacman-coordinates" if controlling_pacman else "ghost-coordinates"
+            payload = tuple(self.pacman.rect[:2]) if controlling_pacman else tuple(self.ghost.rect[:2])
+            now = pygame.time.get_ticks()
+            if payload != self.sent_position or now - self.sent_time >= HEARTBEAT:
+                backend.send(header, payload)
+                self.sent_position = payload
+                self.sent_time = now
+
+        # Receive every message since the last frame, only the newest coordinates are kept.
+        now = pygame.time.get_ticks()
+        messages = backend.receive_all()
+        for index, (header, payload) in enumerate(messages):
 
             match header:
                 case "pacman-coordinates":
-                    self.pacman.rect[:2] = payload
-                    self.pacman.pellet_checker()
+                    # Eat pellets where Pacman really is, the sprite is drawn a little behind.
+                    self.remote_rect = pygame.Rect(*payload, SIZE, SIZE)
+                    self.pacman.pellet_checker(self.remote_rect)
+                    self.remote.add(now, payload)
                 
                 case "ghost-coordinates":
-                    self.ghost.rect[:2] = payload
+                    self.remote_rect = pygame.Rect(*payload, SIZE, SIZE)
+                    self.remote.add(now, payload)
+
+                case "snapshot":
+                    self.apply_snapshot(payload)
                 
                 case "end-game":
                     # End the game.
                     # Play the game over sound effect.
                     self.death_sound_effect.play()
                     # Update the Post Game page score label.
-                    pages[6].update_score_label(self.pacman.score)
+                    pages[7].update_score_label(self.pacman.score)
                     # Reset the page for the next time.
                     self.reset()
                     self.pacman.score = 0
+                    self.sent_keys = None
                     controlling_pacman = False
                     # Change to the Post Game page
                     self.next_page()
-                    return
+                    # The rest of the messages are for the Post Game page.
+                    backend.put_back(messages[index + 1:])
+                    return []
 
                 # An other player has disconnected from the server.
                 case "disconnect":
@@ -495,19 +674,27 @@ class Game(Page):
                     # Change to the start page.
                     self.change_page(0)
                     # Update the title to inform the player.
-                    pages[0].change_title("Player disconnected")
+                    pages[0].change_title("Server disconnected" if payload == "server" else "Player disconnected")
+                    return []
                 
                 case "_":
                     print('unexpected header')
 
+        if not self.authoritative:
+            self.move_remote_sprite(now)
+
         self.score_label.text = f'Score = {self.pacman.score}'
 
-        # Game over check.
-        if self.pacman.has_ghost_eaten_pacman():
+        # Round trip time to the server, to tell network lag apart from a slow frame.
+        rtt = backend.round_trip_time()
+        self.latency_label.text = "Ping ?" if rtt is None else f"Ping {rtt:.0f} ms"
+
+        # Game over check. In authoritative mode the server checks.
+        if not self.authoritative and self.has_ghost_eaten_pacman():
             backend.send("end-game", self.pacman.score)
         
         # Check for victory if all pellets eaten.
-        if len(Pellet.pellet_group) == 0:
+        if not self.authoritative and Pellet.grid.remaining == 0:
             # Play the victory sound effect.
             self.victory.play()
             # Reset the page.
@@ -515,24 +702,77 @@ class Game(Page):
             # Load the next maze.
             self.create_maze()
 
-        # Reset surface and draw HUD.
-        super().update(target_surface)
-        # Draw sprites.
+        return self.draw(target_surface, drawn_rects)
+
+    def draw(self, target_surface, drawn_rects):
+        # Draws the changes since the last frame and returns the rects of the screen that changed.
+        if Page.drawn_page is not self or self.drawn_pellets is not Pellet.grid:
+            # The page has just been shown or the level changed, draw all of it.
+            Page.drawn_page = self
+            self.drawn_pellets = Pellet.grid
+            Pellet.eaten.clear()
+
+            # Reset surface to the level's pre-rendered walls and draw HUD.
+            self.draw_background(target_surface)
+            for widget in self.widgets:
+                widget.update(target_surface)
+            # Draw pellets and sprites.
+            Pellet.draw(target_surface)
+            Placeable.all_group.draw(target_surface)
+            return [target_surface.get_rect()]
+
+        # The sprites that moved, where they were and where they are now.
+        dirty = []
+        for sprite, drawn_rect in zip(Placeable.all_group, drawn_rects):
+            if sprite.rect != drawn_rect:
+                dirty.extend((drawn_rect, sprite.rect.copy()))
+
+        # The pellets eaten since the last frame.
+        dirty.extend(Pellet.eaten)
+        Pellet.eaten.clear()
+
+        # The HUD text that changed, where it was.
+        dirty.extend(widget.rect for widget in self.widgets if widget.changed())
+
+        # Cover everything that changed with the walls, then draw the pellets left there.
+        for rect in dirty:
+            self.draw_background(target_surface, rect)
+        for rect in dirty:
+            Pellet.draw(target_surface, rect)
+
+        for widget in self.widgets:
+            if widget.changed() or widget.rect.collidelist(dirty) != -1:
+                widget.update(target_surface)
+                dirty.append(widget.rect)
+
+        # Draw the sprites on top.
         Placeable.all_group.draw(target_surface)
-        pygame.display.update()
+        return dirty
+
+    def draw_background(self, target_surface, rect=None):
+        # Copies the level's pre-rendered walls to the rect, or to the whole surface if no rect is given.
+        if Wall.background is None:
+            target_surface.fill(BACKGROUND_COLOR, rect)
+        elif rect is None:
+            target_surface.blit(Wall.background, (0, 0))
+        else:
+            target_surface.blit(Wall.background, rect, rect)
     
     def reset(self):
         # Resets the page and its sprites.
         self.pacman.move_to_spawn()
         self.ghost.move_to_spawn()
 
+        # Send the spawn coordinates on the next frame.
+        self.sent_position = None
+        self.remote.clear()
+        self.remote_rect = None
+
         self.pacman.last_key = None
         self.ghost.last_key = None
 
-        Placeable.all_group.remove(Wall.wall_group)
-        Placeable.all_group.remove(Pellet.pellet_group)
-        Pellet.pellet_group.empty()
-        Wall.wall_group.empty()
+        Wall.unload()
+        Pellet.grid = PelletGrid()
 
     def event_handler(self, event):
         # Left mouse button clicked on mute button.
@@ -568,14 +808,12 @@ class PostGame(Page):
         # Left mouse button press on the play again button.
         if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
             if self.submit.rect.collidepoint(event.pos):
-                self.change_page(3)
+                self.change_page(4)
 
     def update(self, target_surface):
-        super().update(target_surface)
-        packet = backend.receive()
-       
-        if packet:
-            header = packet[0]
+        dirty = super().update(target_surface)
+        
+        for header, payload in backend.receive_all():
             
             # A player has disconnected from the server.
             if header == "disconnect":
@@ -584,20 +822,24 @@ class PostGame(Page):
                 # Change to the start page.
                 self.change_page(0)
                 # Update the title to inform the player.
-                pages[0].change_title("Player disconnected")
-    
+                pages[0].change_title("Server disconnected" if payload == "server" else "Player disconnected")
+                return dirty
+
+        return dirty
+
 
 # Create the pages for the GUI.
 page0= Start()
 page1 = IP()
 page2 = Port()
-page3 = Interim()
-page4 = Lobby()
-page5 = Game()
-page6 = PostGame()
+page3 = Room()
+page4 = Interim()
+page5 = Lobby()
+page6 = Game()
+page7 = PostGame()
 
 # Holds the sequence that the pages are to be accessed
-pages = [page0, page1, page2, page3, page4, page5, page6]
+pages = [page0, page1, page2, page3, page4, page5, page6, page7]
 
 # Game loop
 while True:
@@ -605,8 +847,8 @@ while True:
     # Set the max FPS to 60
     clock.tick(FPS)
 
-    # Update the screen's page
-    pages[Page.current_page].update(screen)
+    # Update the screen's page, it returns the parts of the screen that changed
+    dirty = pages[Page.current_page].update(screen)
 
     for event in pygame.event.get():
         # Exit button
@@ -617,7 +859,12 @@ while True:
             # Close program
             exit()
         
+        # The window was covered or minimised, push all of it to the display again.
+        if event.type == pygame.WINDOWEXPOSED:
+            dirty = [screen.get_rect()]
+
         # Handle any events for the page
         pages[Page.current_page].event_handler(event)
 
-    pygame.display.update()
+    # Only push the changed parts of the screen to the display.
+    pygame.display.update(dirty)
@@ -1,64 +1,465 @@
 import socket
-import pickle
+import threading
+import queue
+import time
+from collections import deque
+from version_3_protocol import (Decoder, ProtocolError, coalesce, decode_datagram, encode, encode_datagram,
+                                is_newer, is_replaceable, is_resent)
+from version_3_latency import PING_INTERVAL, LatencyEstimate
+from version_3_shm import SPIN_TIME, WAIT_TIMEOUT, WORTHWHILE, RingBuffer, same_machine
+
+# Seconds without hearing from the server before it is treated as gone. The server pings every second.
+SERVER_TIMEOUT = 5
+
+# Seconds to keep trying to reconnect and resume the session after the connection is lost.
+# The server keeps the player's seat for 15 seconds.
+RESUME_TIMEOUT = 10
+
+# Seconds to wait for room in the shared memory ring before giving up on a message.
+RING_TIMEOUT = 1
 
 class Backend:
 
-    def __init__(self):   
+    def __init__(self, udp=False, shared_memory=True):   
         # Create TCP IPv4 socket object
         self.clientsocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Messages received by the reader thread, waiting to be handled by the pages
+        self.inbox = queue.Queue()
+        # Messages handed back by a page that changed before it handled them
+        self.held = deque()
+
+        # Ask the server for a UDP channel for coordinates. Everything else stays on TCP.
+        self.udp = udp
+        self.udpsocket = None
+        self.udp_registered = False
+        # Sequence number of the last datagram sent
+        self.sequence = 0
+        # Sequence number of the newest datagram received, by header
+        self.newest = {}
+
+        # Round trip time and clock offset to the server, updated by the pong replies.
+        self.latency = LatencyEstimate()
+        # The game loop, the reader thread and the pinger thread all send on the socket.
+        self.send_lock = threading.Lock()
+        # time.monotonic() when the server last sent anything.
+        self.last_received = time.monotonic()
+
+        # Server address, and the token that gets the player's seat back if the connection drops.
+        self.address = None
+        self.session = None
+        # Lobby and match messages the pages sent while the connection was lost, sent once the session is resumed.
+        self.resuming = False
+        self.unsent = deque()
+
+        # Talk to a server on the same machine through shared memory rings instead of TCP or UDP.
+        # The incoming ring belongs to the reader thread.
+        self.shared_memory = shared_memory
+        self.ring_out = None
 
     def create_socket(self):
         self.clientsocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Use a fresh queue so messages from the old connection are never handled.
+        self.inbox = queue.Queue()
+        self.held.clear()
+        self.close_udp()
+        self.close_shm()
+        self.latency = LatencyEstimate()
+        self.session = None
+        self.resuming = False
+        self.unsent.clear()
+
+    def close_udp(self):
+        # Stop using the UDP channel, its reader thread stops once the socket is closed.
+        if self.udpsocket is not None:
+            self.udpsocket.close()
+            self.udpsocket = None
+
+        self.udp_registered = False
+        self.sequence = 0
+        self.newest = {}
+
+    def close_shm(self):
+        # Stop writing to the shared memory ring, the reader thread closes the incoming ring.
+        with self.send_lock:
+            if self.ring_out is not None:
+                self.ring_out.close()
+                self.ring_out = None
 
     def disconnect(self):
+        # Replace the socket first, so the reader thread knows the connection was closed on purpose.
+        clientsocket = self.clientsocket
+        self.create_socket()
+
         try:
-            self.send("disconnect", "_")
-            self.clientsocket.close()
-            self.create_socket()
+            with self.send_lock:
+                clientsocket.sendall(encode("disconnect", "_"))
+            # Wake the reader thread, it stops once the socket is closed.
+            clientsocket.shutdown(socket.SHUT_RDWR)
         
-        except TimeoutError:
+        except OSError:
             pass
 
+        clientsocket.close()
+
 
     def connect(self, ip: str, port: int):
         try:
-            self.clientsocket.connect((str(ip), int(port)))
-            self.clientsocket.settimeout(0.1)  #Seconds before a timeout exception is raised
+            self.address = (str(ip), int(port))
+            self.clientsocket.connect(self.address)
+            # Send each small message straight away instead of waiting to merge it with the next one.
+            self.clientsocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             print("Connection established")
         
         except:
             return False
         
         else:
+            self.__start(self.clientsocket, self.inbox)
             return True
+
+    def __start(self, clientsocket, inbox):
+        # Read from the socket in the background so the game loop never waits on the network.
+        self.last_received = time.monotonic()
+        reader = threading.Thread(target=self.__read, args=(clientsocket, inbox), daemon=True)
+        reader.start()
+
+        # Measure the round trip time to the server in the background.
+        pinger = threading.Thread(target=self.__ping, args=(clientsocket,), daemon=True)
+        pinger.start()
+
+        if self.shared_memory and WORTHWHILE and same_machine(clientsocket):
+            # The server is on this machine, coordinates don't need UDP.
+            self.send("shm-request", "_")
+        elif self.udp:
+            self.send("udp-request", "_")
     
     def send(self, header:str, payload):
+        udpsocket = self.udpsocket
         try:
-            #Send data to the server
-            packet = bytes(pickle.dumps((header, payload)))
-            self.clientsocket.send(packet)
-        
+            if self.udp_registered and udpsocket is not None and is_replaceable(header):
+                # Coordinates go over UDP, a lost datagram is replaced by the next one.
+                self.sequence += 1
+                udpsocket.send(encode_datagram(self.sequence, header, payload))
+                return
+
         except OSError:
             # Socket not connected anymore
-            pass
+            return
+
+        #Send data to the server
+        packet = encode(header, payload)
+        with self.send_lock:
+            if self.resuming and is_resent(header):
+                # The server gets it once it has given the seat back.
+                self.unsent.append(packet)
+                return
+
+            try:
+                self.__send_packet(packet)
+
+            except OSError:
+                # Socket not connected anymore, the message is sent again if the session is resumed.
+                if self.session is not None and is_resent(header):
+                    self.unsent.append(packet)
+
+    def __send_packet(self, packet):
+        #Send a frame on the shared memory ring if there is one, else on the socket. Called with the send lock held.
+        if self.ring_out is not None:
+            self.__write_ring(self.ring_out, packet)
+        else:
+            self.clientsocket.sendall(packet)
+
+    def __send_unsent(self):
+        #Send the messages held back while the connection was lost, the session has been resumed.
+        with self.send_lock:
+            self.resuming = False
+            try:
+                while self.unsent:
+                    self.__send_packet(self.unsent[0])
+                    self.unsent.popleft()
+            except OSError:
+                # Lost again, the rest are sent when the session is resumed next.
+                pass
     
-    def receive(self):
-        #Receive data from server.
+    def __write_ring(self, ring, packet):
+        #Copy a frame into the outgoing ring, waiting for the server to make room if it is full.
+        deadline = time.monotonic() + RING_TIMEOUT
+        while not ring.write(packet):
+            if time.monotonic() > deadline:
+                # The server isn't reading, it is dropped once the TCP connection closes.
+                return
+            time.sleep(0.001)
+
+        if ring.is_waiting():
+            # The server is asleep in its selector, wake it over TCP.
+            ring.set_waiting(False)
+            self.clientsocket.sendall(encode("shm-wake", "_"))
+
+    def round_trip_time(self):
+        #Return the smoothed round trip time to the server in milliseconds, or None before the first pong.
+        if self.latency.rtt is None:
+            return None
+        return self.latency.rtt * 1000
+
+    def server_time(self):
+        #Return the time on the server's clock, in time.time() seconds.
+        return self.latency.remote_time(time.time())
+
+    def receive_all(self):
+        #Return every message received since the last call, oldest first. Never blocks.
+        messages = list(self.held)
+        self.held.clear()
+
+        while True:
+            try:
+                messages.append(self.inbox.get_nowait())
+            except queue.Empty:
+                break
+
+        # Older coordinates and snapshots are out of date, only the newest of each are returned.
+        return coalesce(messages)
+
+    def put_back(self, messages):
+        #Return unhandled messages to the front of the queue, so the next page receives them.
+        self.held.extendleft(reversed(messages))
+
+    def __read(self, clientsocket, inbox):
+        #Runs on the reader thread until the connection is closed.
+        decoder = Decoder()
+
+        # Shared memory: the incoming ring offered by the server, and the one being read once the server has switched.
+        offered = None
+        ring = None
+        ring_decoder = Decoder()
+        last_message = 0
+
+        while True:
+            try:
+                if ring is not None:
+                    data = ring.read()
+                    if data:
+                        arrived = time.time()
+                        last_message = self.last_received = time.monotonic()
+                        ring.set_waiting(False)
+                        for header, payload in ring_decoder.feed(data):
+                            self.__handle(clientsocket, header, payload, arrived, inbox)
+                        continue
+
+                    if time.monotonic() - last_message < SPIN_TIME:
+                        # Another message is likely to follow soon, check again straight away.
+                        time.sleep(0)
+                        continue
+
+                    # Wait on the socket until the server sends "shm-wake", checking once more after setting the flag.
+                    ring.set_waiting(True)
+                    if ring.available():
+                        continue
+
+                try:
+                    data = clientsocket.recv(4096)
+                except socket.timeout:
+                    continue
+
+                arrived = time.time()
+                if not data:
+                    # The server closed the connection.
+                    break
+
+                self.last_received = time.monotonic()
+
+                for header, payload in decoder.feed(data):
+                    match header:
+                        case "shm-offer":
+                            offered = self.__attach_shm(clientsocket, payload)
+
+                        case "shm-switched" if offered is not None:
+                            # Everything the server sent over TCP has been handled, read the ring from now on.
+                            ring = offered
+                            # A wake up can be missed if both sides check at once, so don't wait long.
+                            clientsocket.settimeout(WAIT_TIMEOUT)
+
+                        case _:
+                            self.__handle(clientsocket, header, payload, arrived, inbox)
+
+            except (OSError, ProtocolError):
+                # Socket closed or the stream can't be decoded anymore.
+                break
+
+        if offered is not None:
+            offered.close()
+
+        if clientsocket is not self.clientsocket:
+            # The client disconnected on purpose.
+            return
+
+        if self.session is not None:
+            with self.send_lock:
+                # Hold the pages' messages back until the server has given the seat back.
+                self.resuming = True
+
+            if self.__resume(clientsocket, inbox):
+                return
+
+        with self.send_lock:
+            self.resuming = False
+            self.unsent.clear()
+
+        # The connection was lost and can't be resumed, tell the pages.
+        inbox.put(("disconnect", "server"))
+
+    def __handle(self, clientsocket, header, payload, arrived, inbox):
+        #Handle a message from the server, on the TCP or shared memory reader thread.
+        match header:
+            case "udp-offer":
+                self.__open_udp(clientsocket, payload, inbox)
+
+            case "udp-registered":
+                # The server knows our UDP address, start sending coordinates over UDP.
+                self.udp_registered = True
+
+            case "shm-wake":
+                # Woke the reader thread up, the ring is read next.
+                pass
+
+            case "session":
+                self.session = payload
+
+            case "session-resumed":
+                print("Connection resumed")
+                self.__send_unsent()
+
+            case "session-expired":
+                # The server gave the seat away, give up on this connection.
+                self.session = None
+                clientsocket.shutdown(socket.SHUT_RDWR)
+
+            case "ping":
+                # Answer straight away, the game loop may be busy drawing a frame.
+                self.send("pong", (payload, arrived, time.time()))
+
+            case "pong":
+                if clientsocket is self.clientsocket:
+                    self.latency.update(*payload, arrived)
+
+            case _:
+                if header == "start-game":
+                    # Sequence numbers start again in a new match.
+                    self.newest.clear()
+                inbox.put((header, payload))
+
+    def __attach_shm(self, clientsocket, name):
+        #Open the shared memory rings offered by the server. Returns the incoming ring,
+        #or None if the client stays on TCP.
         try:
-            packet = self.clientsocket.recv(1024)
-            packet = pickle.loads(packet)
-        
-        except socket.timeout:
+            ring_in = RingBuffer(f"{name}-down")
+        except (OSError, ValueError):
             return None
-            
-        except pickle.UnpicklingError:
+        try:
+            ring_out = RingBuffer(f"{name}-up")
+        except (OSError, ValueError):
+            ring_in.close()
             return None
 
-        except EOFError:
-            return None
+        with self.send_lock:
+            try:
+                # The last message sent over TCP, the server reads the ring after it.
+                clientsocket.sendall(encode("shm-attached", "_"))
+            except OSError:
+                ring_in.close()
+                ring_out.close()
+                return None
 
-        except ConnectionResetError:
-            return None
+            self.ring_out = ring_out
+            return ring_in
 
-        else:
-            return packet
\ No newline at end of file
+    def __resume(self, lost, inbox):
+        #Reconnect to the server and ask for the player's seat back. Returns False if the server can't be reached.
+        #The pages keep running meanwhile and never see the connection drop.
+        session = self.session
+        deadline = time.monotonic() + RESUME_TIMEOUT
+
+        while time.monotonic() < deadline:
+            try:
+                clientsocket = socket.create_connection(self.address, timeout=1)
+            except OSError:
+                time.sleep(0.2)
+                continue
+
+            if lost is not self.clientsocket:
+                # The client disconnected while reconnecting.
+                clientsocket.close()
+                return True
+
+            clientsocket.settimeout(None)
+            clientsocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            lost.close()
+
+            # The other player drops datagrams older than the last one, so keep counting from there.
+            sequence = self.sequence
+            self.close_udp()
+            self.sequence = sequence
+            self.close_shm()
+
+            with self.send_lock:
+                # Nothing can be sent on the new connection before the session is resumed.
+                self.clientsocket = clientsocket
+                try:
+                    clientsocket.sendall(encode("resume-session", session))
+                except OSError:
+                    # The new reader thread finds the connection closed and tries again.
+                    pass
+
+            self.__start(clientsocket, inbox)
+            return True
+
+        return False
+
+    def __ping(self, clientsocket):
+        #Runs on the pinger thread until the client disconnects.
+        while clientsocket is self.clientsocket:
+            if time.monotonic() - self.last_received > SERVER_TIMEOUT:
+                # The server stopped answering without closing the connection.
+                # Shutting the socket down wakes the reader thread, which tells the pages.
+                try:
+                    clientsocket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                break
+
+            self.send("ping", time.time())
+            time.sleep(PING_INTERVAL)
+
+    def __open_udp(self, clientsocket, offer, inbox):
+        #Open the UDP channel offered by the server.
+        token, port = offer
+        udpsocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udpsocket.connect((clientsocket.getpeername()[0], port))
+        udpsocket.settimeout(0.2)  #Seconds between registration attempts
+        self.udpsocket = udpsocket
+
+        reader = threading.Thread(target=self.__read_udp, args=(udpsocket, token, inbox), daemon=True)
+        reader.start()
+
+    def __read_udp(self, udpsocket, token, inbox):
+        #Runs on the UDP reader thread until the UDP socket is closed.
+        while True:
+            try:
+                if not self.udp_registered:
+                    # Datagrams can be lost, keep registering until the server confirms it.
+                    udpsocket.send(encode_datagram(0, "udp-register", token))
+
+                sequence, header, payload = decode_datagram(udpsocket.recv(2048))
+
+            except (socket.timeout, ConnectionRefusedError, ProtocolError):
+                continue
+
+            except OSError:
+                # Socket closed.
+                break
+
+            # Drop datagrams that arrived after a newer one.
+            if header in self.newest and not is_newer(sequence, self.newest[header]):
+                continue
+
+            self.newest[header] = sequence
+            inbox.put((header, payload))
@@ -0,0 +1,78 @@
+from collections import deque
+
+'''
+Smooths the movement of the other player's sprite.
+
+Coordinates are stored with the time they arrived and the sprite is drawn a small fixed
+delay behind, between the two samples either side of that time. If the next sample is
+late, the sprite keeps moving in the direction it was last going for a short while.
+'''
+
+
+class SnapshotBuffer(object):
+    def __init__(self, delay: int, max_extrapolation: int, speed: float, teleport_distance: int):
+        self.delay = delay                                      # Milliseconds the sprite is drawn behind
+        self.max_extrapolation = max_extrapolation              # Milliseconds to keep moving without data
+        self.speed = speed                                      # Pixels per millisecond
+        self.teleport_distance = teleport_distance              # Jumps further than this are not smoothed
+
+        # (time, x, y) samples, oldest first.
+        self.samples = deque(maxlen=32)
+
+    def clear(self):
+        self.samples.clear()
+
+    def add(self, time: int, position: tuple):
+        self.samples.append((time, position[0], position[1]))
+
+    def __direction(self):
+        # Returns the (x, y) unit direction between the last two different samples.
+        last = self.samples[-1]
+        for sample in reversed(self.samples):
+            dx, dy = last[1] - sample[1], last[2] - sample[2]
+            if (dx or dy) and abs(dx) + abs(dy) <= self.teleport_distance:
+                # The sprites only move along one axis at a time.
+                if abs(dx) >= abs(dy):
+                    return (1 if dx > 0 else -1, 0)
+                return (0, 1 if dy > 0 else -1)
+            if dx or dy:
+                # The sprite teleported, the direction before that is out of date.
+                break
+        return None
+
+    def sample(self, now: int):
+        '''
+        Returns the (x, y) position to draw at the given time and True if it was extrapolated.
+        Returns None if there are no samples.
+        '''
+        if not self.samples:
+            return None
+
+        render_time = now - self.delay
+
+        # Find the samples either side of the render time.
+        previous = None
+        for sample in self.samples:
+            if sample[0] > render_time:
+                if previous is None:
+                    # Older than every sample.
+                    return (sample[1], sample[2]), False
+
+                dx, dy = sample[1] - previous[1], sample[2] - previous[2]
+                if abs(dx) + abs(dy) > self.teleport_distance:
+                    # Don't slide across the screen through a tunnel.
+                    return (previous[1], previous[2]), False
+
+                fraction = (render_time - previous[0]) / (sample[0] - previous[0])
+                return (round(previous[1] + dx * fraction), round(previous[2] + dy * fraction)), False
+
+            previous = sample
+
+        # The newest sample is older than the render time, the data is late.
+        time, x, y = self.samples[-1]
+        direction = self.__direction()
+        if direction is None:
+            return (x, y), False
+
+        distance = self.speed * min(render_time - time, self.max_extrapolation)
+        return (round(x + direction[0] * distance), round(y + direction[1] * distance)), True
@@ -0,0 +1,64 @@
+from collections import deque
+
+'''
+Round trip time and clock offset estimates, used by the client backend and the server.
+
+One side sends a ping holding its clock time, the other side answers with a pong holding
+that time, the time the ping arrived and the time the pong was sent. The pong's arrival
+gives four times, the same as an NTP exchange:
+    round trip time = (arrived - sent) - (replied - received)
+    clock offset    = ((received - sent) + (replied - arrived)) / 2
+
+Times are time.time() seconds. The offset is how far the other side's clock is ahead.
+'''
+
+# Seconds between pings.
+PING_INTERVAL = 1.0
+
+
+class LatencyEstimate(object):
+    # Weight of a new sample in the running averages, the same as TCP's smoothed RTT.
+    GAIN = 1 / 8
+    # Recent samples searched for the best clock offset.
+    WINDOW = 8
+
+    def __init__(self):
+        self.rtt = None                                         # Smoothed round trip time, seconds
+        self.jitter = 0.0                                       # Smoothed difference between samples, seconds
+        self.offset = 0.0                                       # Other clock minus this clock, seconds
+        self.samples = 0
+
+        # (round trip time, clock offset) of the recent samples.
+        self.recent = deque(maxlen=LatencyEstimate.WINDOW)
+
+    def update(self, sent: float, received: float, replied: float, arrived: float):
+        # Adds the times of one ping/pong exchange.
+        rtt = max(0.0, (arrived - sent) - (replied - received))
+        offset = ((received - sent) + (replied - arrived)) / 2
+
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.jitter += (abs(rtt - self.rtt) - self.jitter) * LatencyEstimate.GAIN
+            self.rtt += (rtt - self.rtt) * LatencyEstimate.GAIN
+
+        # The quickest exchange was delayed the least, so its offset is the most accurate.
+        self.recent.append((rtt, offset))
+        self.offset = min(self.recent)[1]
+        self.samples += 1
+
+    def remote_time(self, local_time: float):
+        # Converts a time on this clock to the other side's clock.
+        return local_time + self.offset
+
+    def local_time(self, remote_time: float):
+        # Converts a time on the other side's clock to this clock.
+        return remote_time - self.offset
+
+    def to_dict(self):
+        return {
+            "rtt_ms": round(self.rtt * 1000, 3) if self.rtt is not None else None,
+            "jitter_ms": round(self.jitter * 1000, 3),
+            "clock_offset_ms": round(self.offset * 1000, 3),
+            "samples": self.samples,
+        }
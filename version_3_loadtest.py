@@ -0,0 +1,224 @@
+import argparse
+import selectors
+import socket
+import time
+from version_3_protocol import Decoder, ProtocolError, encode
+
+'''
+Load generator and latency benchmark for version_3_server.py.
+
+Spawns pairs of bot clients that speak the same protocol as the game's Backend.
+Each pair joins its own room, goes through the lobby and character selection,
+then both bots stream coordinates at a fixed rate. The coordinates carry a
+sequence number, so the other bot can measure how long each one took to be relayed.
+
+Example, against a server on this machine:
+    python version_3_server.py --headless --host 127.0.0.1 --port 5000
+    python version_3_loadtest.py --port 5000 --pairs 100 --rate 60 --duration 10
+'''
+
+def encode_sequence(sequence: int):
+    # Packs a sequence number into a pair of coordinates.
+    return (sequence & 0x7FFF, (sequence >> 15) & 0x7FFF)
+
+
+def decode_sequence(coordinates: tuple):
+    return coordinates[0] | (coordinates[1] << 15)
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Bot(object):
+    def __init__(self, address, room: str, role: str):
+        self.role = role
+        self.header = f"{role}-coordinates"
+        self.peer = None
+
+        self.socket = socket.create_connection(address)
+        # Send small messages straight away, like the Backend does.
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setblocking(False)
+        self.decoder = Decoder()
+        self.outbox = bytearray()
+
+        # "lobby" -> "selecting" -> "streaming", or "failed"
+        self.state = "lobby"
+
+        # Send time of every coordinate message, by sequence number.
+        self.sequence = 0
+        self.sent = {}
+
+        self.received = 0
+        self.garbled = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+        self.send("join-room", room)
+        self.send("lobby-load-request", "_")
+
+    def send(self, header: str, payload="_"):
+        packet = encode(header, payload)
+        self.outbox += packet
+        self.bytes_sent += len(packet)
+        self.flush()
+
+    def flush(self):
+        try:
+            sent = self.socket.send(self.outbox)
+            del self.outbox[:sent]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.state = "failed"
+            self.outbox.clear()
+
+    def send_coordinates(self, now: float):
+        self.sequence += 1
+        self.sent[self.sequence] = now
+        self.send(self.header, encode_sequence(self.sequence))
+
+    def receive(self, now: float, latencies: list):
+        try:
+            data = self.socket.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+
+        if not data:
+            self.state = "failed"
+            return
+
+        self.bytes_received += len(data)
+
+        try:
+            messages = self.decoder.feed(data)
+        except ProtocolError:
+            self.garbled += 1
+            self.state = "failed"
+            return
+
+        for header, payload in messages:
+            match header:
+                case "lobby-load-granted":
+                    self.state = "selecting"
+                    self.send(f"{self.role}-selected", "_")
+
+                case "start-game":
+                    self.state = "streaming"
+
+                case "pacman-coordinates" | "ghost-coordinates":
+                    sent = self.peer.sent.pop(decode_sequence(payload), None)
+                    if header == self.header or sent is None:
+                        # Not something the other bot sent, or sent twice.
+                        self.garbled += 1
+                    else:
+                        self.received += 1
+                        latencies.append(now - sent)
+
+                case "ping":
+                    # The server measures its round trip time to every client.
+                    self.send("pong", (payload, time.time(), time.time()))
+
+                case "pacman-selected" | "ghost-selected" | "udp-offer" | "udp-registered" | "session":
+                    pass
+
+                case _:
+                    # disconnect, room-full or anything unexpected.
+                    self.garbled += 1
+                    self.state = "failed"
+
+
+def run(address, pairs: int, rate: float, duration: float, setup_timeout: float, drain: float):
+    selector = selectors.DefaultSelector()
+    bots = []
+
+    # Connect every pair, each pair plays in its own room.
+    for index in range(pairs):
+        pacman = Bot(address, f"loadtest-{index}", "pacman")
+        ghost = Bot(address, f"loadtest-{index}", "ghost")
+        pacman.peer, ghost.peer = ghost, pacman
+        for bot in (pacman, ghost):
+            bots.append(bot)
+            selector.register(bot.socket, selectors.EVENT_READ, bot)
+
+    latencies = []
+    interval = 1 / rate
+    started = time.monotonic()
+    stream_start = None
+    stream_end = None
+    next_send = started
+
+    while True:
+        now = time.monotonic()
+
+        if stream_start is None:
+            # Wait for every pair to get through the lobby.
+            if all(bot.state in ("streaming", "failed") for bot in bots) or now - started > setup_timeout:
+                stream_start = next_send = now
+                stream_end = now + duration
+
+        elif now < stream_end:
+            # Send coordinates on a fixed schedule, catching up if the loop fell behind.
+            while next_send <= now:
+                for bot in bots:
+                    if bot.state == "streaming":
+                        bot.send_coordinates(time.monotonic())
+                next_send += interval
+
+        elif now > stream_end + drain:
+            break
+
+        for bot in bots:
+            if bot.outbox:
+                bot.flush()
+
+        timeout = max(0.0, next_send - time.monotonic()) if stream_start is not None else 0.01
+        for key, mask in selector.select(timeout=min(timeout, 0.01)):
+            key.data.receive(time.monotonic(), latencies)
+
+    for bot in bots:
+        selector.unregister(bot.socket)
+        bot.socket.close()
+    selector.close()
+
+    # Report.
+    streaming = sum(1 for bot in bots if bot.state == "streaming")
+    sent = sum(bot.sequence for bot in bots)
+    received = sum(bot.received for bot in bots)
+    garbled = sum(bot.garbled for bot in bots)
+    dropped = sum(len(bot.sent) for bot in bots)
+    bytes_sent = sum(bot.bytes_sent for bot in bots)
+    bytes_received = sum(bot.bytes_received for bot in bots)
+    latencies.sort()
+
+    print(f"pairs:          {pairs} ({streaming // 2} reached the game, {len(bots) - streaming} clients failed)")
+    print(f"sent:           {sent} coordinate messages, {bytes_sent} bytes")
+    print(f"relayed:        {received} messages, {received / duration:.0f} messages/s, {bytes_received} bytes received")
+    print(f"dropped:        {dropped}")
+    print(f"garbled:        {garbled}")
+    print(f"latency p50:    {percentile(latencies, 0.5) * 1000:.2f} ms")
+    print(f"latency p99:    {percentile(latencies, 0.99) * 1000:.2f} ms")
+    print(f"latency max:    {(latencies[-1] if latencies else float('nan')) * 1000:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pacman server load generator")
+    parser.add_argument("--host", default="127.0.0.1", help="server address")
+    parser.add_argument("--port", type=int, required=True, help="server port")
+    parser.add_argument("--pairs", type=int, default=10, help="number of simulated matches")
+    parser.add_argument("--rate", type=float, default=60, help="coordinate messages per second from each client")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to stream coordinates for")
+    parser.add_argument("--setup-timeout", type=float, default=10, help="seconds to wait for every pair to start its game")
+    parser.add_argument("--drain", type=float, default=1, help="seconds to wait for the last messages after streaming")
+    args = parser.parse_args()
+
+    run((args.host, args.port), args.pairs, args.rate, args.duration, args.setup_timeout, args.drain)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import hashlib
+import os
+import struct
+
+'''
+Compiled mazes, shared by the client's rendering and collisions and the server's simulation.
+
+A maze text file is parsed once into a CompiledMaze: one byte per tile for the walls and the
+pellets, the spawn tiles and the rows with a tunnel at the edge. Later loads of the same file
+return the same object, so changing level doesn't read or parse anything.
+
+Compiled mazes can also be saved in a folder, named after a hash of the text file, so a big
+maze is only parsed the first time any process loads it. The saved file is:
+    header  - MAGIC, columns, rows, Pacman's spawn (col, row), the Ghost's spawn (col, row)
+    walls   - columns * rows bytes, 1 where the tile is a wall
+    pellets - columns * rows bytes, 1 where the tile holds a pellet
+'''
+
+# Characters of the text format, any other character is an empty tile.
+WALL = "x"
+PELLET = "o"
+
+# Spawn tiles, the text format doesn't mark them.
+PACMAN_SPAWN = (1, 1)
+GHOST_SPAWN = (15, 8)
+
+MAGIC = b"PMZ1"
+HEADER = struct.Struct("!4sHHHHHH")
+
+# Path -> (modification time, CompiledMaze)
+loaded = {}
+
+
+class CompiledMaze(object):
+    '''
+    The layout of a maze. Nothing in it changes once it is made, so every game can share it.
+    '''
+    def __init__(self, columns: int, rows: int, walls: bytes, pellets: bytes, pacman_spawn=PACMAN_SPAWN,
+                 ghost_spawn=GHOST_SPAWN):
+        self.columns = columns
+        self.rows = rows
+        self.walls = bytes(walls)
+        self.pellets = bytes(pellets)
+        self.pellet_count = self.pellets.count(1)
+        self.pacman_spawn = pacman_spawn
+        self.ghost_spawn = ghost_spawn
+
+        # Rows that are open at the left or right edge, where the players go through to the other side.
+        self.tunnel_rows = tuple(row for row in range(rows) if columns and
+                                 (not self.walls[row * columns] or not self.walls[row * columns + columns - 1]))
+
+    def wall_tiles(self):
+        # Returns the (col, row) of every wall.
+        return [divmod(index, self.columns)[::-1] for index, tile in enumerate(self.walls) if tile]
+
+    def to_bytes(self):
+        return HEADER.pack(MAGIC, self.columns, self.rows, *self.pacman_spawn, *self.ghost_spawn) + self.walls + self.pellets
+
+    @staticmethod
+    def from_bytes(data: bytes):
+        # Returns the CompiledMaze saved by to_bytes, or None if the data isn't one.
+        if len(data) < HEADER.size:
+            return None
+
+        magic, columns, rows, pacman_col, pacman_row, ghost_col, ghost_row = HEADER.unpack_from(data)
+        tiles = columns * rows
+        if magic != MAGIC or len(data) != HEADER.size + 2 * tiles:
+            return None
+
+        walls = data[HEADER.size:HEADER.size + tiles]
+        pellets = data[HEADER.size + tiles:]
+        return CompiledMaze(columns, rows, walls, pellets, (pacman_col, pacman_row), (ghost_col, ghost_row))
+
+
+def compile_maze(text: str):
+    '''
+    Returns the CompiledMaze of a maze's text.
+    Key:
+        "x" = wall
+        "o" = pellet
+    '''
+    lines = text.splitlines()
+    columns = max((len(line) for line in lines), default=0)
+    rows = len(lines)
+
+    walls = bytearray(columns * rows)
+    pellets = bytearray(columns * rows)
+    for row, line in enumerate(lines):
+        for col, char in enumerate(line):
+            if char == WALL:
+                walls[row * columns + col] = 1
+            elif char == PELLET:
+                pellets[row * columns + col] = 1
+
+    return CompiledMaze(columns, rows, walls, pellets)
+
+
+def load(filename: str, cache_dir=None):
+    # Returns the CompiledMaze of a maze file, parsing it only the first time or after it changes.
+    modified = os.stat(filename).st_mtime_ns
+    cached = loaded.get(filename)
+    if cached is not None and cached[0] == modified:
+        return cached[1]
+
+    with open(filename, "rb") as f:
+        text = f.read()
+
+    maze = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, hashlib.sha1(text).hexdigest() + ".maze")
+        try:
+            with open(path, "rb") as f:
+                maze = CompiledMaze.from_bytes(f.read())
+        except OSError:
+            pass
+
+    if maze is None:
+        maze = compile_maze(text.decode("utf-8"))
+
+        if cache_dir is not None:
+            # Replace the saved maze in one step, so other processes never read half a file.
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                temporary = f"{path}.{os.getpid()}.tmp"
+                with open(temporary, "wb") as f:
+                    f.write(maze.to_bytes())
+                os.replace(temporary, path)
+            except OSError:
+                pass
+
+    loaded[filename] = (modified, maze)
+    return maze
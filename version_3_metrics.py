@@ -0,0 +1,153 @@
+import json
+import os
+import time
+
+'''
+Server instrumentation: message and byte counters, and processing time histograms.
+Every method is called from the server's event loop thread, so no locks are needed.
+'''
+
+
+class Histogram(object):
+    '''
+    Counts durations in power of two buckets of microseconds: <1us, <2us, <4us ... up to about 17 minutes.
+    '''
+    BUCKETS = 31
+
+    def __init__(self):
+        self.counts = [0] * Histogram.BUCKETS
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        microseconds = int(seconds * 1_000_000)
+        self.counts[min(microseconds.bit_length(), Histogram.BUCKETS - 1)] += 1
+        self.total += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction: float):
+        # Returns the upper bound, in seconds, of the bucket holding the given fraction of the values.
+        if not self.total:
+            return 0.0
+
+        target = fraction * self.total
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return (1 << bucket) / 1_000_000
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.total,
+            "mean_us": round(self.sum / self.total * 1_000_000, 2) if self.total else 0,
+            "p50_us": self.percentile(0.5) * 1_000_000,
+            "p99_us": self.percentile(0.99) * 1_000_000,
+            "max_us": round(self.max * 1_000_000, 2),
+            # Upper bound of each bucket in microseconds -> count, empty buckets left out.
+            "buckets": {str(1 << bucket): count for bucket, count in enumerate(self.counts) if count},
+        }
+
+
+class ConnectionStats(object):
+    def __init__(self):
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.messages_out = 0
+        self.bytes_out = 0
+        self.connected = time.time()
+
+
+class Metrics(object):
+    def __init__(self):
+        self.started = time.time()
+
+        # Header -> [messages, bytes]
+        self.headers_in = {}
+        self.headers_out = {}
+
+        # Header -> processing time Histogram
+        self.processing = {}
+
+        # Totals for connections that have closed.
+        self.connections_opened = 0
+        self.connections_closed = 0
+
+        # Coordinates and snapshots dropped because a client wasn't keeping up.
+        self.dropped = 0
+
+    def opened(self, connection):
+        connection.stats = ConnectionStats()
+        self.connections_opened += 1
+
+    def closed(self, connection):
+        self.connections_closed += 1
+
+    def received(self, connection, header: str, size: int):
+        connection.stats.messages_in += 1
+        connection.stats.bytes_in += size
+        counts = self.headers_in.setdefault(header, [0, 0])
+        counts[0] += 1
+        counts[1] += size
+
+    def sent(self, connection, header: str, size: int):
+        connection.stats.messages_out += 1
+        connection.stats.bytes_out += size
+        counts = self.headers_out.setdefault(header, [0, 0])
+        counts[0] += 1
+        counts[1] += size
+
+    def processed(self, header: str, seconds: float):
+        histogram = self.processing.get(header)
+        if histogram is None:
+            histogram = self.processing[header] = Histogram()
+        histogram.record(seconds)
+
+    def report(self, server):
+        # Returns every statistic as a dictionary that can be saved as JSON.
+        queue_depths = [connection.outbox_bytes for connection in server.clients]
+
+        return {
+            "time": time.time(),
+            "uptime": round(time.time() - self.started, 3),
+            "clients": len(server.clients),
+            "rooms": len(server.rooms),
+            "matches": len(server.matches),
+            "connections_opened": self.connections_opened,
+            "connections_closed": self.connections_closed,
+            "relay_queue": {
+                "total_bytes": sum(queue_depths),
+                "max_bytes": max(queue_depths, default=0),
+                "dropped_messages": self.dropped,
+            },
+            "headers_in": {header: {"messages": counts[0], "bytes": counts[1]} for header, counts in self.headers_in.items()},
+            "headers_out": {header: {"messages": counts[0], "bytes": counts[1]} for header, counts in self.headers_out.items()},
+            "processing": {header: histogram.to_dict() for header, histogram in self.processing.items()},
+            "connections": [
+                {
+                    "address": f"{connection.address[0]}:{connection.address[1]}",
+                    "room": connection.room.id if connection.room is not None else None,
+                    "udp": connection.udp_address is not None,
+                    "shared_memory": connection.ring_in is not None,
+                    "messages_in": connection.stats.messages_in,
+                    "bytes_in": connection.stats.bytes_in,
+                    "messages_out": connection.stats.messages_out,
+                    "bytes_out": connection.stats.bytes_out,
+                    "queue_bytes": connection.outbox_bytes,
+                    "queue_messages": len(connection.outbox),
+                    "latency": connection.latency.to_dict(),
+                    "connected_for": round(time.time() - connection.stats.connected, 3),
+                }
+                for connection in server.clients
+            ],
+        }
+
+    def dump(self, server, path: str):
+        # Replace the stats file in one step, so readers never see half a file.
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(self.report(server), f, indent=1)
+        os.replace(temporary, path)
@@ -0,0 +1,263 @@
+import struct
+from enum import IntEnum
+
+'''
+Binary wire protocol shared by the client backend and the server.
+
+Every message is sent as a frame:
+    2 bytes  - length of the body (unsigned, network byte order)
+    1 byte   - message type
+    n bytes  - body, laid out according to the message type
+
+The length prefix lets the receiver split a TCP stream back into whole messages,
+no matter how the packets were merged or split on the way.
+
+UDP datagrams hold a single frame after a 4 byte sequence number, so the receiver
+can drop datagrams that arrive after a newer one.
+'''
+
+
+class MessageType(IntEnum):
+    PACMAN_COORDINATES = 1
+    GHOST_COORDINATES = 2
+    PACMAN_SELECTED = 3
+    GHOST_SELECTED = 4
+    END_GAME = 5
+    LOBBY_LOAD_REQUEST = 6
+    LOBBY_LOAD_GRANTED = 7
+    GAME_LOAD_REQUEST = 8
+    START_GAME = 9
+    DISCONNECT = 10
+    JOIN_ROOM = 11
+    ROOM_FULL = 12
+    INPUT = 13
+    SNAPSHOT = 14
+    UDP_REQUEST = 15
+    UDP_OFFER = 16
+    UDP_REGISTER = 17
+    UDP_REGISTERED = 18
+    PING = 19
+    PONG = 20
+    SESSION = 21
+    RESUME_SESSION = 22
+    SESSION_RESUMED = 23
+    SESSION_EXPIRED = 24
+    SHM_REQUEST = 25
+    SHM_OFFER = 26
+    SHM_ATTACHED = 27
+    SHM_SWITCHED = 28
+    SHM_WAKE = 29
+
+
+class ProtocolError(ValueError):
+    # Raised when a frame can't be encoded or decoded.
+    pass
+
+
+# Frame header: body length followed by the message type.
+FRAME_HEADER = struct.Struct("!HB")
+
+# Body layouts.
+EMPTY = None                                                    # No body, the payload is "_"
+TEXT = "text"                                                   # UTF-8 encoded string
+COORDINATES = struct.Struct("!hh")                              # (x, y) in pixels
+SCORE = struct.Struct("!i")                                     # Pacman's score
+FLAG = struct.Struct("!B")                                      # 0 or 1
+INPUT = struct.Struct("!B")                                     # Bitmask of the held arrow keys
+SNAPSHOT = struct.Struct("!IBhhhhi")                            # Tick, maze, Pacman (x, y), Ghost (x, y), score
+UDP_OFFER = struct.Struct("!IH")                                # Token, UDP port
+TOKEN = struct.Struct("!I")                                     # Token from the UDP offer
+PING = struct.Struct("!d")                                      # Sender's clock time, seconds
+PONG = struct.Struct("!ddd")                                    # Ping's time, time it arrived, time of the reply
+
+# Sequence number at the start of every UDP datagram.
+DATAGRAM_HEADER = struct.Struct("!I")
+
+# Header -> (message type, body layout).
+MESSAGES = {
+    "pacman-coordinates": (MessageType.PACMAN_COORDINATES, COORDINATES),
+    "ghost-coordinates": (MessageType.GHOST_COORDINATES, COORDINATES),
+    "pacman-selected": (MessageType.PACMAN_SELECTED, EMPTY),
+    "ghost-selected": (MessageType.GHOST_SELECTED, EMPTY),
+    "end-game": (MessageType.END_GAME, SCORE),
+    "lobby-load-request": (MessageType.LOBBY_LOAD_REQUEST, EMPTY),
+    "lobby-load-granted": (MessageType.LOBBY_LOAD_GRANTED, EMPTY),
+    "game-load-request": (MessageType.GAME_LOAD_REQUEST, EMPTY),     # Ignored, the server starts the game once both players pick
+    "start-game": (MessageType.START_GAME, FLAG),              # 1 if the server runs the simulation
+    "disconnect": (MessageType.DISCONNECT, EMPTY),
+    "join-room": (MessageType.JOIN_ROOM, TEXT),
+    "room-full": (MessageType.ROOM_FULL, EMPTY),
+    "input": (MessageType.INPUT, INPUT),
+    "snapshot": (MessageType.SNAPSHOT, SNAPSHOT),
+    "udp-request": (MessageType.UDP_REQUEST, EMPTY),           # Client asks for a UDP channel
+    "udp-offer": (MessageType.UDP_OFFER, UDP_OFFER),
+    "udp-register": (MessageType.UDP_REGISTER, TOKEN),         # Sent over UDP so the server learns the client's address
+    "udp-registered": (MessageType.UDP_REGISTERED, EMPTY),
+    "ping": (MessageType.PING, PING),                          # Either side can ping, the other answers with a pong
+    "pong": (MessageType.PONG, PONG),
+    "session": (MessageType.SESSION, TEXT),                    # Token for resuming the session after losing the connection
+    "resume-session": (MessageType.RESUME_SESSION, TEXT),      # First message on the new connection, holds the token
+    "session-resumed": (MessageType.SESSION_RESUMED, EMPTY),
+    "session-expired": (MessageType.SESSION_EXPIRED, EMPTY),
+    "shm-request": (MessageType.SHM_REQUEST, EMPTY),           # Client on the same machine asks for shared memory rings
+    "shm-offer": (MessageType.SHM_OFFER, TEXT),                # Name of the rings, see version_3_shm.py
+    "shm-attached": (MessageType.SHM_ATTACHED, EMPTY),
+    "shm-switched": (MessageType.SHM_SWITCHED, EMPTY),
+    "shm-wake": (MessageType.SHM_WAKE, EMPTY),                 # Sent over TCP, something was written to a sleeping reader's ring
+}
+
+# Message type -> (header, body layout).
+HEADERS = {message_type: (header, layout) for header, (message_type, layout) in MESSAGES.items()}
+
+# Message types that are replaced by the next message of the same type.
+REPLACEABLE = {MessageType.PACMAN_COORDINATES, MessageType.GHOST_COORDINATES, MessageType.SNAPSHOT}
+
+# Message types a player can't do without, they are kept while the connection is lost and sent once the
+# session is resumed. Coordinates and snapshots are out of date by then.
+RESENT = {MessageType.PACMAN_SELECTED, MessageType.GHOST_SELECTED, MessageType.END_GAME, MessageType.LOBBY_LOAD_REQUEST,
+          MessageType.LOBBY_LOAD_GRANTED, MessageType.START_GAME, MessageType.DISCONNECT, MessageType.INPUT}
+
+# Message types the server forwards without decoding, and the size of their frames.
+RELAY_ONLY = {
+    MessageType.PACMAN_COORDINATES: FRAME_HEADER.size + COORDINATES.size,
+    MessageType.GHOST_COORDINATES: FRAME_HEADER.size + COORDINATES.size,
+}
+
+
+def encode(header: str, payload="_"):
+    # Returns the frame for a message as bytes.
+    try:
+        message_type, layout = MESSAGES[header]
+    except KeyError:
+        raise ProtocolError(f"unknown header {header!r}")
+
+    if layout is EMPTY:
+        body = b""
+    elif layout is TEXT:
+        body = str(payload).encode("utf-8")
+    elif isinstance(payload, (tuple, list)):
+        body = layout.pack(*payload)
+    else:
+        body = layout.pack(payload)
+
+    if len(body) > 0xFFFF:
+        raise ProtocolError(f"{header!r} payload is too large")
+
+    return FRAME_HEADER.pack(len(body), message_type) + body
+
+
+def frame_type(frame):
+    # Returns the message type of a frame without decoding it.
+    return frame[2]
+
+
+def decode_frame(frame):
+    # Returns the (header, payload) tuple held in a single complete frame.
+    message_type = frame_type(frame)
+    try:
+        header, layout = HEADERS[message_type]
+    except KeyError:
+        raise ProtocolError(f"unknown message type {message_type}")
+
+    body = frame[FRAME_HEADER.size:]
+
+    try:
+        if layout is EMPTY:
+            payload = "_"
+        elif layout is TEXT:
+            payload = bytes(body).decode("utf-8")
+        else:
+            payload = layout.unpack(body)
+            # Single value layouts decode to the value itself.
+            if len(payload) == 1:
+                payload = payload[0]
+    except (struct.error, UnicodeDecodeError):
+        raise ProtocolError(f"malformed {header!r} frame")
+
+    return header, payload
+
+
+def encode_datagram(sequence: int, header: str, payload="_"):
+    # Returns a UDP datagram holding one message.
+    return DATAGRAM_HEADER.pack(sequence & 0xFFFFFFFF) + encode(header, payload)
+
+
+def decode_datagram(datagram):
+    # Returns the (sequence, header, payload) of a UDP datagram.
+    if len(datagram) < DATAGRAM_HEADER.size + FRAME_HEADER.size:
+        raise ProtocolError("datagram is too short")
+
+    sequence = DATAGRAM_HEADER.unpack_from(datagram)[0]
+    frame = memoryview(datagram)[DATAGRAM_HEADER.size:]
+    if FRAME_HEADER.unpack_from(frame)[0] != len(frame) - FRAME_HEADER.size:
+        raise ProtocolError("datagram length doesn't match its frame")
+
+    header, payload = decode_frame(frame)
+    return sequence, header, payload
+
+
+def is_newer(sequence: int, last: int):
+    # Compares sequence numbers, allowing them to wrap around.
+    return 0 < (sequence - last) & 0xFFFFFFFF < 0x80000000
+
+
+class Decoder:
+    '''
+    Splits a byte stream back into frames.
+    Bytes of an incomplete frame are kept until the rest of it arrives.
+    '''
+    def __init__(self):
+        self.buffer = b""
+
+    def split(self, data):
+        # Returns a list of every complete frame in the stream, as memoryviews.
+        if self.buffer:
+            data = self.buffer + data
+
+        view = memoryview(data)
+        frames = []
+        offset = 0
+
+        while len(view) - offset >= FRAME_HEADER.size:
+            length = FRAME_HEADER.unpack_from(view, offset)[0]
+            end = offset + FRAME_HEADER.size + length
+
+            if end > len(view):
+                # Wait for the rest of the frame.
+                break
+
+            frames.append(view[offset:end])
+            offset = end
+
+        # Keep the incomplete frame for the next call.
+        self.buffer = bytes(view[offset:])
+        return frames
+
+    def feed(self, data):
+        # Returns the (header, payload) tuple of every complete message in the stream.
+        return [decode_frame(frame) for frame in self.split(data)]
+
+
+def is_replaceable(header: str):
+    # Coordinates and snapshots are replaced by the next one, so only the newest is worth handling.
+    # An unknown header isn't, encode reports it.
+    message = MESSAGES.get(header)
+    return message is not None and message[0] in REPLACEABLE
+
+
+def is_resent(header: str):
+    # Lobby and match messages are sent again after the session is resumed, so the pages never miss one.
+    message = MESSAGES.get(header)
+    return message is not None and message[0] in RESENT
+
+
+def coalesce(messages):
+    # Returns the messages in order, keeping only the newest coordinates and snapshot.
+    # Every other message is a control message and is always kept.
+    newest = {}
+    for index, (header, payload) in enumerate(messages):
+        if is_replaceable(header):
+            newest[header] = index
+
+    return [message for index, message in enumerate(messages)
+            if not is_replaceable(message[0]) or newest[message[0]] == index]
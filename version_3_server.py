@@ -1,79 +1,283 @@
+import argparse
+import logging
 import socket
+import secrets
+import selectors
+import sys
 import threading
-import pickle
-import pygame
-from version_3_widgets import *
+import time
+from collections import deque
+from itertools import islice
+from version_3_protocol import (DATAGRAM_HEADER, HEADERS, RELAY_ONLY, REPLACEABLE, RESENT, Decoder, ProtocolError,
+                                decode_datagram, decode_frame, encode, encode_datagram, frame_type)
+from version_3_metrics import Metrics
+from version_3_latency import PING_INTERVAL, LatencyEstimate
+from version_3_shm import SPIN_TIME, WAIT_TIMEOUT, RingBuffer, same_machine
+from version_3_simulation import MAZES, Match
+
+log = logging.getLogger("pacman-server")
+
+# Frames per second of the information window, it only shows the IP and port.
+GUI_FPS = 10
+
+# Simulation ticks per second in authoritative mode, the same as the client's frame rate.
+TICK_RATE = 60
+TICK = 1 / TICK_RATE
+# Ticks the simulation may run at once to catch up after a slow loop.
+MAX_CATCH_UP = 5
+
+# Outgoing queue limits for each connection, in bytes.
+MAX_QUEUE = 64 * 1024                   # Above this the oldest coordinates and snapshots are dropped
+MAX_QUEUE_HARD = 1024 * 1024            # Above this the client is too slow and is disconnected
+
+# Kernel send buffer of each client socket, in bytes. Kept small so a slow reader's backlog stays in the
+# outgoing queue, where old coordinates can be dropped, instead of piling up in the kernel.
+SEND_BUFFER = 8 * 1024
+
+# Frames handed to the socket in one call.
+SEND_BATCH = 64
+
+# Seconds without hearing from a client before it is disconnected. Clients ping every second.
+IDLE_TIMEOUT = 10
+
+# Seconds a player's seat is kept after the connection is lost, waiting for the client to resume its session.
+SESSION_GRACE = 15
+
+# Players needed to start a match: one Pacman and one Ghost.
+ROOM_SIZE = 2
+
+# Room joined by clients that don't ask for one.
+DEFAULT_ROOM = ""
+
+class Connection(object):
+    def __init__(self, conn, address):
+        self.socket = conn
+        self.address = address
+        # Splits this connection's byte stream into messages.
+        self.decoder = Decoder()
+        # Frames waiting to be sent once the socket is writable, oldest first.
+        self.outbox = deque()
+        # Bytes of the first frame that have already been sent.
+        self.outbox_offset = 0
+        # Bytes waiting in the outbox.
+        self.outbox_bytes = 0
+        # True while the selector is waiting for the socket to become writable.
+        self.writing = False
+        # True once sending failed or the connection was lost, nothing more is sent to it.
+        self.broken = False
+        # The room the client is playing in, None until it joins one.
+        self.room = None
+        # True once the client was told the room it asked for is full, it isn't put in the default room.
+        self.refused = False
+        # UDP channel: the token the client registers with and its UDP address once registered.
+        self.udp_token = None
+        self.udp_address = None
+        # Round trip time and clock offset to the client, updated by the pong replies.
+        self.latency = LatencyEstimate()
+        # time.monotonic() when the client last sent anything.
+        self.last_received = time.monotonic()
+        # Token the client can resume its session with, given when it joins a room.
+        self.session = None
+        # time.monotonic() when the connection was lost, None while it is connected.
+        self.lost = None
+        # Lobby and match frames that weren't sent because the connection was lost, sent when the client
+        # resumes its session. None once too many have piled up to catch the client up.
+        self.missed = deque()
+        self.missed_bytes = 0
+        # Shared memory rings for a client on the same machine: offered, then in use once it has attached.
+        self.rings = None
+        self.ring_in = None
+        self.ring_out = None
+        self.ring_decoder = Decoder()
+        # Frames waiting for room in the outgoing ring.
+        self.ring_backlog = deque()
+        self.ring_backlog_bytes = 0
+
+
+class Room(object):
+    def __init__(self, room_id: str):
+        self.id = room_id
+        #Connections of the players in this room.
+        self.clients = []
+
+        # Lobby and game state for the match in this room.
+        self.lobby_load_requests = 0
+        # Connections that have picked a character for the next match.
+        self.ready_players = set()
+        self.score = None
+
+        # Authoritative mode: character chosen by each connection and the running match.
+        self.roles = {}
+        self.match = None
+        self.maze_number = 0
+
+        # Newest coordinates frame of each player, by message type, sent to a client that resumes its session.
+        self.positions = {}
+
+    def is_full(self):
+        return len(self.clients) >= ROOM_SIZE
+
+
+def find_ip():
+    # Returns this machine's network address.
+    # Get the hostname of the machine
+    hostname = socket.gethostname()
+    
+    # Get the available addresses for the hostname on any port
+    addresses = socket.getaddrinfo(hostname, None, socket.AF_INET, socket.SOCK_STREAM)
+
+    for address in addresses:
+        # Find an IPv4 address that is not the loopback address
+        if address[0] == socket.AF_INET and address[4][0] != '127.0.0.1':
+            return address[4][0]
+
+    # No network address found, listen on every interface.
+    return "0.0.0.0"
+
+
+def session_room(token: str):
+    # Returns the id of the room a session token was given in. Tokens are "room/random hex".
+    return token.rpartition("/")[0]
 
-pygame.init()
 
 class Server(object):
-    def __init__(self):
+    def __init__(self, ip=None, port=0, headless=False, authoritative=False, stats_file=None, stats_interval=5,
+                 shared_memory=True, handoff=None):
         try:
 
-            self.ip = None
+            self.ip = ip
             self.port = None
+            self.headless = headless
+            # Run the game on the server, clients only send input and draw snapshots.
+            self.authoritative = authoritative
 
-            # Get the hostname of the machine
-            hostname = socket.gethostname()
-            
-            # Get the available addresses for the hostname on any port
-            addresses = socket.getaddrinfo(hostname, None, socket.AF_INET, socket.SOCK_STREAM)
+            if self.ip is None:
+                self.ip = find_ip()
 
-            for address in addresses:
-                # Find an IPv4 address that is not the loopback address
-                if address[0] == socket.AF_INET and address[4][0] != '127.0.0.1':
-                    self.ip = address[4][0]
-                    break
+            # Worker process: connections are accepted by the front process and handed over on this socket.
+            self.handoff = handoff
 
-            #Create TCP IPv4 socket.
-            self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            # Bind the socket to free port.
-            self.serversocket.bind((self.ip, 0))
+            if handoff is None:
+                #Create TCP IPv4 socket.
+                self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                # Bind the socket to the given port, 0 picks a free port.
+                self.serversocket.bind((self.ip, port))
 
-            self.port = self.serversocket.getsockname()[1]
+                self.port = self.serversocket.getsockname()[1]
+            else:
+                self.serversocket = None
+                self.port = port
 
-            #Array of connection tuples like (conn, addr) 
-            self.clients = []
+            # UDP socket on the same port for coordinates and snapshots. Each worker has its own port.
+            self.udpsocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                self.udpsocket.bind((self.ip, self.port if handoff is None else 0))
+                self.udpsocket.setblocking(False)
+                self.udp_port = self.udpsocket.getsockname()[1]
+            except OSError:
+                # The UDP port is taken, every client stays on TCP.
+                log.warning(f"UDP port {self.port} unavailable, coordinates are sent over TCP")
+                self.udpsocket.close()
+                self.udpsocket = None
 
-            self.lobby_load_requests = 0
+            # Connections by UDP token and by registered UDP address.
+            self.udp_tokens = {}
+            self.udp_clients = {}
 
-            self.ready_players = 0
-            self.game_load_granted = 0
+            #Set of Connection objects for every connected client.
+            self.clients = set()
 
-            self.score = None
-            self.usernames = []
+            #Rooms that have at least one player, by room id.
+            self.rooms = {}
 
-            self.screen = pygame.display.set_mode((500, 300))
-            self.screen.fill(BACKGROUND_COLOR)
-            pygame.display.set_caption("Pacman server")
-            
+            #Rooms with a running match in authoritative mode.
+            self.matches = set()
+
+            # Connections by session token, including lost ones waiting to be resumed.
+            self.sessions = {}
+
+            # Clients on this machine talk through shared memory rings instead of TCP.
+            self.shared_memory = shared_memory
+            self.shm_clients = set()
+            # time.monotonic() of the last message through a ring.
+            self.shm_active = 0
+
+            # Waits for socket events so every connection is served by one thread.
+            self.selector = selectors.DefaultSelector()
+
+            # Counters and histograms, saved to the stats file every stats_interval seconds.
+            self.metrics = Metrics()
+            self.stats_file = stats_file
+            self.stats_interval = stats_interval
+
+            self.usernames = []
 
             self.shutdown_flag = threading.Event()
 
+            # The event loop owns every socket and all lobby state, so no locks are needed.
             threading.Thread(target=self.listen).start() 
 
-            self.gui() # Update the screen
+            if handoff is None:
+                log.info(f"listening on {self.ip}:{self.port}")
+
+            if self.headless:
+                self.wait()
+            else:
+                self.gui() # Update the screen
         except OSError:
-            print("Server currently open")
+            log.error("Server currently open")
 
     def exit(self):
         self.shutdown_flag.set()
 
-        # Close the server
-        self.serversocket.close()
-        
         # Close threads safely
         for thread in threading.enumerate():
             if thread != threading.current_thread():
                 thread.join()
+
+        # Close the server and every connection
+        for connection in self.clients:
+            connection.socket.close()
+            self.close_rings(connection)
+        self.selector.close()
+        if self.serversocket is not None:
+            self.serversocket.close()
+        if self.handoff is not None:
+            self.handoff.close()
+        if self.udpsocket is not None:
+            self.udpsocket.close()
         
-        # Quit Pygame
-        pygame.quit()
+        if not self.headless:
+            # Quit Pygame
+            import pygame
+            pygame.quit()
+
+        log.info("server closed")
 
         # Terminate Python
-        exit()
+        sys.exit()
+
+    def wait(self):
+        # Headless mode: sleep until the process is interrupted.
+        # A worker also stops when the front process goes away.
+        try:
+            while not self.shutdown_flag.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        self.exit()
 
     def gui(self):
+        # Pygame is only needed for the window, so headless hosts don't need it installed.
+        import pygame
+        from version_3_widgets import Page, Text, BACKGROUND_COLOR
+
+        pygame.init()
+        screen = pygame.display.set_mode((500, 300))
+        screen.fill(BACKGROUND_COLOR)
+        pygame.display.set_caption("Pacman server")
+        clock = pygame.time.Clock()
+
         class Information(Page):
             def __init__(self, ip: str, port: str):
                 self.ip = Text(25, 50, f"IP = {ip}", 48)
@@ -83,7 +287,10 @@ class Server(object):
         information_page = Information(self.ip, self.port)
 
         while True:
-            information_page.update(self.screen)
+            # Limit the frame rate so the networking gets the CPU.
+            clock.tick(GUI_FPS)
+
+            information_page.update(screen)
 
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
@@ -92,126 +299,868 @@ class Server(object):
             pygame.display.update()
 
     def serialise(self, header, payload):
-            return bytes(pickle.dumps((header, payload)))
-    
-    def receive_and_respond(self, conn, address):
-        print(f'new connection: {address}')
+            return encode(header, payload)
+
+    def send(self, connection, packet):
+        # Queue the packet behind the ones already waiting. Every byte is sent in order, unless
+        # the queue is full and the packet is coordinates or a snapshot that a newer one replaces.
+        if connection.broken:
+            self.keep_missed(connection, packet)
+            return
+
+        self.metrics.sent(connection, HEADERS[frame_type(packet)][0], len(packet))
+
+        if connection.ring_out is not None:
+            self.send_ring(connection, packet)
+        else:
+            self.send_tcp(connection, packet)
+
+    def send_tcp(self, connection, packet):
+        connection.outbox.append(packet)
+        connection.outbox_bytes += len(packet)
+
+        if connection.outbox_bytes > MAX_QUEUE:
+            self.shed(connection)
+
+        if not connection.writing:
+            # The socket had room last time, so try sending now.
+            self.flush(connection)
+
+    def shed(self, connection):
+        # The client isn't keeping up, drop queued coordinates and snapshots, oldest first,
+        # until the queue is half full so this doesn't run again on the next send.
+        # Control messages are never dropped.
+        kept = deque()
+        for index, frame in enumerate(connection.outbox):
+            partly_sent = index == 0 and connection.outbox_offset
+            if connection.outbox_bytes > MAX_QUEUE // 2 and not partly_sent and frame_type(frame) in REPLACEABLE:
+                connection.outbox_bytes -= len(frame)
+                self.metrics.dropped += 1
+            else:
+                kept.append(frame)
+        connection.outbox = kept
 
-        def send_to_other_client(packet):
+        if connection.outbox_bytes > MAX_QUEUE_HARD:
+            # Even the control messages aren't getting through, disconnect the client.
+            log.warning(f"{connection.address} is not reading, disconnecting it")
+            self.abandon(connection)
+
+    def keep_missed(self, connection, packet):
+        # Keep a lobby or match frame for a client that may resume its session.
+        if connection.session is None or connection.missed is None or frame_type(packet) not in RESENT:
+            return
+
+        connection.missed.append(packet)
+        connection.missed_bytes += len(packet)
+        if connection.missed_bytes > MAX_QUEUE:
+            # Too far behind to catch up, the session can't be resumed.
+            connection.missed = None
+
+    def keep_unsent(self, connection):
+        # The frames still queued for a lost connection are sent again if the client resumes its session.
+        for frame in (*connection.outbox, *connection.ring_backlog):
+            self.keep_missed(connection, frame)
+
+        connection.outbox.clear()
+        connection.outbox_offset = 0
+        connection.outbox_bytes = 0
+        connection.ring_backlog.clear()
+        connection.ring_backlog_bytes = 0
+
+    def abandon(self, connection):
+        # Stop sending to a connection, the next read sees it closed and cleans it up.
+        connection.broken = True
+        self.keep_unsent(connection)
+        try:
+            connection.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def send_ring(self, connection, packet):
+        # Copy the frame into the client's shared memory ring, or queue it until the client makes room.
+        if not connection.ring_backlog and connection.ring_out.write(packet):
+            self.wake(connection)
+            return
+
+        connection.ring_backlog.append(bytes(packet))
+        connection.ring_backlog_bytes += len(packet)
+        if connection.ring_backlog_bytes > MAX_QUEUE_HARD:
+            log.warning(f"{connection.address} is not reading, disconnecting it")
+            self.abandon(connection)
+
+    def wake(self, connection):
+        # The client's ring reader is asleep, wake it over TCP.
+        if connection.ring_out.is_waiting():
+            connection.ring_out.set_waiting(False)
+            self.send_tcp(connection, self.serialise("shm-wake", "_"))
+
+    def offer_shm(self, connection):
+        # Give a client on this machine a pair of rings, it keeps using TCP if it can't have them.
+        if not self.shared_memory or connection.rings is not None or not same_machine(connection.socket):
+            return
+
+        name = f"pacman-{secrets.token_hex(6)}"
+        try:
+            up = RingBuffer(f"{name}-up", create=True)
+        except OSError as error:
+            log.warning(f"could not create shared memory: {error}")
+            return
+        try:
+            down = RingBuffer(f"{name}-down", create=True)
+        except OSError as error:
+            log.warning(f"could not create shared memory: {error}")
+            up.close()
+            return
+
+        connection.rings = (up, down)
+        self.send(connection, self.serialise("shm-offer", name))
+
+    def switch_to_shm(self, connection):
+        # The client has attached and sends nothing more over TCP. Send the switch over TCP
+        # so the client reads everything sent before it first, then use the rings.
+        if connection.rings is None or connection.ring_in is not None:
+            return
+
+        self.send(connection, self.serialise("shm-switched", "_"))
+        connection.ring_in, connection.ring_out = connection.rings
+        self.shm_clients.add(connection)
+        log.info(f"{connection.address} switched to shared memory")
+
+    def poll_rings(self):
+        # Handle the frames the shared memory clients have written, and send their queued frames.
+        # Returns True if anything was read.
+        active = False
+        for connection in list(self.shm_clients):
+            if connection.ring_backlog:
+                while connection.ring_backlog and connection.ring_out.write(connection.ring_backlog[0]):
+                    connection.ring_backlog_bytes -= len(connection.ring_backlog.popleft())
+                self.wake(connection)
+
+            connection.ring_in.set_waiting(False)
+            data = connection.ring_in.read()
+            if data:
+                active = True
+                connection.last_received = time.monotonic()
+                try:
+                    frames = connection.ring_decoder.split(data)
+                except ProtocolError:
+                    self.close(connection)
+                    continue
+
+                try:
+                    self.handle_frames(connection, frames)
+                except Exception:
+                    self.fail(connection)
+
+        return active
+
+    def ring_timeout(self, timeout):
+        # Returns how long the selector may wait, the rings can't wake it up by themselves.
+        if time.monotonic() - self.shm_active < SPIN_TIME:
+            # Another message is likely to follow soon, keep checking.
+            return 0
+
+        # Ask the clients to send "shm-wake" over TCP with their next message.
+        for connection in self.shm_clients:
+            connection.ring_in.set_waiting(True)
+
+        # Something may have been written before the flag was set.
+        if any(connection.ring_in.available() for connection in self.shm_clients):
+            return 0
+
+        # A wake up can be missed if both sides check at once, so don't sleep for long.
+        return min(timeout, WAIT_TIMEOUT)
+
+    def close_rings(self, connection):
+        self.shm_clients.discard(connection)
+        if connection.rings is not None:
+            for ring in connection.rings:
+                ring.close()
+        connection.rings = connection.ring_in = connection.ring_out = None
+        connection.ring_backlog.clear()
+        connection.ring_backlog_bytes = 0
+
+    def send_to_other_client(self, sender, packet):
+        # Only the players in the sender's room receive the packet.
+        for client in sender.room.clients:
+            if client is not sender:
+                self.send(client, packet)
+
+    def send_to_every_client(self, room, packet):
+        for client in room.clients:
+            self.send(client, packet)
+
+    def stream_to_every_client(self, room, sequence, header, payload):
+        # Send a message that is replaced by the next one, over UDP to clients that have a UDP channel.
+        datagram = None
+        for client in room.clients:
+            if client.udp_address is not None:
+                datagram = datagram or encode_datagram(sequence, header, payload)
+                self.send_datagram(client, datagram)
+            else:
+                self.send(client, self.serialise(header, payload))
+
+    def send_datagram(self, connection, datagram):
+        self.metrics.sent(connection, HEADERS[datagram[DATAGRAM_HEADER.size + 2]][0], len(datagram))
+        try:
+            self.udpsocket.sendto(datagram, connection.udp_address)
+        except OSError:
+            # A lost datagram is replaced by the next one.
+            pass
+
+    def relay_datagram(self, sender, datagram):
+        # Forward a datagram to the other players in the room, over TCP if they have no UDP channel.
+        for client in sender.room.clients:
+            if client is sender:
+                continue
+            if client.udp_address is not None:
+                self.send_datagram(client, datagram)
+            else:
+                self.send(client, memoryview(datagram)[DATAGRAM_HEADER.size:])
+
+    def offer_udp(self, connection):
+        # Give the client a token to register its UDP address with.
+        if self.udpsocket is None:
+            return
+
+        if connection.udp_token is None:
+            token = secrets.randbits(32)
+            while token in self.udp_tokens:
+                token = secrets.randbits(32)
+            connection.udp_token = token
+            self.udp_tokens[token] = connection
+
+        self.send(connection, self.serialise("udp-offer", (connection.udp_token, self.udp_port)))
+
+    def receive_datagrams(self):
+        # Handle the waiting datagrams, a limited number so TCP clients aren't starved.
+        for _ in range(64):
             try:
-                for client in self.clients:
-                    if client[1] != address:
-                        client[0].send(packet)
-            except BrokenPipeError:
-                pass
-        
-        def send_to_every_client(packet):
+                datagram, address = self.udpsocket.recvfrom(2048)
+
+            except BlockingIOError:
+                return
+
+            except OSError:
+                # An ICMP error for an earlier datagram.
+                continue
+
+            connection = self.udp_clients.get(address)
+            frame = memoryview(datagram)[DATAGRAM_HEADER.size:]
+            if connection is not None:
+                connection.last_received = time.monotonic()
+
+            if len(frame) > 2 and frame_type(frame) in RELAY_ONLY:
+                # Fast path: forward the coordinates without decoding them.
+                if connection is not None and connection.room is not None and len(frame) == RELAY_ONLY[frame_type(frame)]:
+                    start = time.perf_counter()
+                    header = HEADERS[frame_type(frame)][0]
+                    self.metrics.received(connection, header, len(datagram))
+                    connection.room.positions[frame_type(frame)] = frame
+                    self.relay_datagram(connection, datagram)
+                    self.metrics.processed(header, time.perf_counter() - start)
+                continue
+
             try:
-                for conn, address in self.clients:
-                    conn.send(packet)
-            
-            except BrokenPipeError:
+                sequence, header, payload = decode_datagram(datagram)
+            except ProtocolError:
+                continue
+
+            if header == "udp-register":
+                connection = self.udp_tokens.get(payload)
+                if connection is not None:
+                    if connection.udp_address is not None:
+                        self.udp_clients.pop(connection.udp_address, None)
+                    connection.udp_address = address
+                    self.udp_clients[address] = connection
+                    self.send(connection, self.serialise("udp-registered", "_"))
+
+    def join_room(self, connection, room_id: str):
+        # Moves the connection into a room, creating the room if it is new.
+        # Returns False if the room already has a full match.
+        room = self.rooms.get(room_id)
+        if room is connection.room and room is not None:
+            return True
+
+        if room is not None and room.is_full():
+            return False
+
+        self.leave_room(connection)
+
+        if room is None:
+            room = self.rooms[room_id] = Room(room_id)
+
+        room.clients.append(connection)
+        connection.room = room
+        connection.refused = False
+        log.info(f"{connection.address} joined room {room_id!r}")
+
+        # Give the client a token to get its seat back if the connection drops.
+        # The token names the room, so a sharded server can send the client back to the same worker.
+        self.sessions.pop(connection.session, None)
+        connection.session = f"{room_id}/{secrets.token_hex(8)}"
+        self.sessions[connection.session] = connection
+        self.send(connection, self.serialise("session", connection.session))
+        return True
+
+    def resume_session(self, connection, token: str):
+        # Give a reconnecting client the seat of its lost connection, and the state it needs to carry on.
+        lost = self.sessions.get(token)
+        if lost is None or lost is connection or lost.room is None or connection.room is not None:
+            self.send(connection, self.serialise("session-expired", "_"))
+            return
+
+        if lost in self.clients:
+            # The client noticed the connection was dead before the server did.
+            self.close(lost, resumable=True)
+
+        if lost.missed is None:
+            # Too much happened while the client was away, it starts again.
+            log.info(f"{connection.address} missed too much to resume its session")
+            self.send(connection, self.serialise("session-expired", "_"))
+            self.end_session(lost)
+            return
+
+        room = lost.room
+        room.clients[room.clients.index(lost)] = connection
+        connection.room = room
+        if lost in room.roles:
+            room.roles[connection] = room.roles.pop(lost)
+        if lost in room.ready_players:
+            room.ready_players.discard(lost)
+            room.ready_players.add(connection)
+
+        connection.session = token
+        self.sessions[token] = connection
+        log.info(f"{connection.address} resumed its session in room {room.id!r}")
+
+        self.send(connection, self.serialise("session-resumed", "_"))
+        # What was sent while the connection was lost, in order.
+        for frame in lost.missed:
+            self.send(connection, frame)
+        lost.missed.clear()
+        # The characters the other players have picked for the next match, in case the connection
+        # was lost while they were on the way, and where the players are now.
+        for client in room.ready_players:
+            if client is not connection:
+                self.send(connection, self.serialise(f"{room.roles[client]}-selected", "_"))
+        own = f"{room.roles.get(connection)}-coordinates"
+        for message_type, frame in room.positions.items():
+            if HEADERS[message_type][0] != own:
+                self.send(connection, frame)
+
+    def end_session(self, connection):
+        # The player isn't coming back, tell the rest of the room and give up the seat.
+        self.sessions.pop(connection.session, None)
+        if connection.room is not None:
+            self.send_to_other_client(connection, self.serialise("disconnect", "_"))
+        self.leave_room(connection)
+
+    def expire_sessions(self, now: float):
+        for connection in list(self.sessions.values()):
+            if connection.lost is not None and now - connection.lost > SESSION_GRACE:
+                log.info(f"session of {connection.address} expired")
+                self.end_session(connection)
+
+    def leave_room(self, connection):
+        room = connection.room
+        if room is None:
+            return
+
+        room.clients.remove(connection)
+        room.roles.pop(connection, None)
+        connection.room = None
+        self.stop_match(room)
+
+        if not room.clients:
+            # Forget empty rooms.
+            del self.rooms[room.id]
+        else:
+            # The match can't continue, the next player starts it again.
+            room.lobby_load_requests = 0
+            room.ready_players.clear()
+            room.positions.clear()
+
+    def flush(self, connection):
+        # Send queued frames until the queue is empty or the socket is full.
+        outbox = connection.outbox
+        while outbox:
+            buffers = [memoryview(outbox[0])[connection.outbox_offset:], *islice(outbox, 1, SEND_BATCH)]
+            try:
+                if hasattr(connection.socket, "sendmsg"):
+                    # Send every frame in one call without joining them.
+                    sent = connection.socket.sendmsg(buffers)
+                else:
+                    sent = connection.socket.send(b"".join(buffers))
+
+            except BlockingIOError:
+                break
+
+            except OSError:
+                self.abandon(connection)
+                return
+
+            connection.outbox_bytes -= sent
+            full = sent < sum(len(buffer) for buffer in buffers)
+
+            # Remove the frames that were sent completely.
+            while sent:
+                remaining = len(outbox[0]) - connection.outbox_offset
+                if sent >= remaining:
+                    sent -= remaining
+                    outbox.popleft()
+                    connection.outbox_offset = 0
+                else:
+                    connection.outbox_offset += sent
+                    sent = 0
+
+            if full:
+                break
+
+        # Only wait for the socket to become writable while there is something left to send.
+        writing = bool(connection.outbox)
+        if writing != connection.writing:
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+            try:
+                self.selector.modify(connection.socket, events, connection)
+                connection.writing = writing
+            except (KeyError, ValueError):
+                # The connection has already been closed.
                 pass
 
-        while not self.shutdown_flag.is_set():
-            #Receive packet object as bytes.
-            packet = self.receive(conn)
+    def respond(self, connection, header, payload, packet, received):
+        if header == "join-room":
+            if not self.join_room(connection, payload):
+                connection.refused = connection.room is None
+                self.send(connection, self.serialise("room-full", "_"))
+            return
+
+        if header == "udp-request":
+            self.offer_udp(connection)
+            return
+
+        if header == "resume-session":
+            self.resume_session(connection, payload)
+            return
+
+        if header == "shm-request":
+            self.offer_shm(connection)
+            return
+
+        if header == "shm-attached":
+            self.switch_to_shm(connection)
+            return
+
+        if header == "shm-wake":
+            # The rings are checked after every selector wake up.
+            return
+
+        if header == "ping":
+            # Clients ping from the moment they connect, before they join a room.
+            self.send(connection, self.serialise("pong", (payload, received, time.time())))
+            return
+
+        if header == "pong":
+            connection.latency.update(*payload, received)
+            return
+
+        if connection.room is None:
+            if header == "disconnect":
+                # The client left before joining a room, there is no other player to tell.
+                log.info(f"disconnect received from {connection.address}")
+                self.close(connection)
+                return
+
+            if connection.refused:
+                # The client was told its room is full and goes back to the start page,
+                # the messages it sends on the way out don't belong to any room.
+                return
+
+            if not self.join_room(connection, DEFAULT_ROOM):
+                # Older clients that never ask for a room play in the default room.
+                connection.refused = True
+                self.send(connection, self.serialise("room-full", "_"))
+                return
+
+        room = connection.room
+
+        #Perform action depending on the header.
+        match header:
+
+            case "pacman-coordinates":
+                room.positions[frame_type(packet)] = packet
+                self.send_to_other_client(connection, packet)
+            
+            case "ghost-coordinates":
+                room.positions[frame_type(packet)] = packet
+                self.send_to_other_client(connection, packet)
+
+            case "pacman-selected":
+                self.player_ready(room, connection, "pacman", packet)
+            
+            case "ghost-selected":
+                self.player_ready(room, connection, "ghost", packet)
+
+            case "input":
+                # Arrow keys held by a player, used on the next tick.
+                if room.match is not None and connection in room.roles:
+                    player = room.match.pacman if room.roles[connection] == "pacman" else room.match.ghost
+                    player.keys = payload
             
-            if packet:
-                #Deserialise packet and select the header.
-                header = pickle.loads(packet)[0]
-                payload = pickle.loads(packet)[1]
-
-                #Perform action depending on the header.
-                match header:
-
-                    case "pacman-coordinates":
-                        send_to_other_client(packet)
-                    
-                    case "ghost-coordinates":
-                        send_to_other_client(packet)
-
-                    case "pacman-selected":
-                        send_to_other_client(packet)
-                        self.ready_players += 1
-                    
-                    case "ghost-selected":
-                        send_to_other_client(packet)
-                        self.ready_players += 1
-                    
-                    case "end-game":
-                        self.score = payload
-                        send_to_every_client(packet)
-
-                    case "lobby-load-request":
-                        self.lobby_load_requests += 1
-
-                        if self.lobby_load_requests == 2:
-                            # Grant lobby access
-                            packet = self.serialise("lobby-load-granted", "_")
-                            send_to_every_client(packet)
-                        
-                            # Reset attributes for the next game
-                            self.lobby_load_requests = 0
-                            self.lobby_load_granted = 0
-                    
-                    case "game-load-request":
-                        if self.ready_players == 2:
-                            packet = self.serialise("start-game", "_")
-                            send_to_every_client(packet)
-                            self.game_load_granted += 1
-                            print(self.game_load_granted)
-                        
-                        if self.game_load_granted == 2:
-                            # Reset attributes for the next game
-                            self.ready_players = 0
-                            self.game_load_granted = 0
-                    
-                    case "disconnect":
-                        print('disconnect received')
-                        self.clients.remove((conn, address))
-                        send_to_other_client(packet)
-
-                    case _:
-                        print("unexpected header")
+            case "end-game":
+                room.score = payload
+                self.send_to_every_client(room, packet)
+                self.stop_match(room)
+
+            case "lobby-load-request":
+                room.lobby_load_requests += 1
+
+                if room.lobby_load_requests == ROOM_SIZE:
+                    # Grant lobby access
+                    packet = self.serialise("lobby-load-granted", "_")
+                    self.send_to_every_client(room, packet)
+                
+                    # Reset attributes for the next game
+                    room.lobby_load_requests = 0
+            
+            case "game-load-request":
+                # Older clients keep asking to start, the server now starts the game by itself.
+                pass
             
+            case "disconnect":
+                log.info(f"disconnect received from {connection.address}")
+                self.close(connection)
+
+            case _:
+                log.warning(f"unexpected header {header!r}")
+
+    def player_ready(self, room, connection, role: str, packet):
+        if any(client is not connection and room.roles.get(client) == role for client in room.ready_players):
+            # Both players clicked the same character at once, the first pick counts.
+            # Tell the client again, so it picks the other character.
+            self.send(connection, self.serialise(f"{role}-selected", "_"))
+            return
+
+        self.send_to_other_client(connection, packet)
+        room.roles[connection] = role
+        room.ready_players.add(connection)
+
+        picked = sorted(room.roles[client] for client in room.ready_players)
+        if picked == ["ghost", "pacman"]:
+            # One Pacman and one Ghost, start the game once.
+            self.send_to_every_client(room, self.serialise("start-game", int(self.authoritative)))
+            self.start_match(room)
+            log.info(f"room {room.id!r} start-game")
+
+            # Reset attributes for the next game
+            room.ready_players.clear()
+            room.positions.clear()
+
+    def start_match(self, room):
+        # Authoritative mode: the server runs the match until the Ghost eats Pacman.
+        if self.authoritative and room.match is None:
+            room.match = Match(room.maze_number)
+            self.matches.add(room)
+
+    def stop_match(self, room):
+        # The players pick their characters again for the next match.
+        room.roles.clear()
+
+        if room.match is not None:
+            # The next match continues from the next maze, like the clients do.
+            room.maze_number = (room.match.maze_number + 1) % len(MAZES)
+            room.match = None
+            self.matches.discard(room)
+
+    def tick(self):
+        # Advance every running match by one tick and send the clients a snapshot.
+        start = time.perf_counter()
+
+        for room in list(self.matches):
+            match = room.match
+
+            if match.step():
+                # The Ghost has eaten Pacman.
+                room.score = match.score
+                self.send_to_every_client(room, self.serialise("end-game", match.score))
+                self.stop_match(room)
+            else:
+                self.stream_to_every_client(room, match.tick, "snapshot", match.snapshot())
+
+        self.metrics.processed("tick", time.perf_counter() - start)
+
+    def accept(self):
+        try:
+            #Accept connection with socket.
+            conn, address = self.serversocket.accept()
+
+        except BlockingIOError:
+            return
+
+        log.info(f"new connection: {address}")
+        self.add_connection(conn, address)
+
+    def adopt(self):
+        # Worker process: take over a connection the front process accepted, with the bytes it already read.
+        try:
+            data, fds, flags, address = socket.recv_fds(self.handoff, 65536, 1)
+        except BlockingIOError:
+            return
+
+        if not fds:
+            # The front process has stopped.
+            log.info("front process closed, shutting down")
+            self.shutdown_flag.set()
+            return
+
+        conn = socket.socket(fileno=fds[0])
+        try:
+            address = conn.getpeername()
+        except OSError:
+            # The client left while it was handed over.
+            conn.close()
+            return
+
+        log.info(f"new connection: {address}")
+        connection = self.add_connection(conn, address)
+        self.handle_frames(connection, connection.decoder.split(data))
+
+    def add_connection(self, conn, address):
+        conn.setblocking(False)
+        # Relay each small message straight away instead of waiting to merge it with the next one.
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+
+        #Add client socket information to list and watch it for incoming data.
+        connection = Connection(conn, address)
+        self.metrics.opened(connection)
+        self.clients.add(connection)
+        self.selector.register(conn, selectors.EVENT_READ, connection)
+        return connection
+
+    def close(self, connection, resumable=False):
+        #Stop watching the connection and remove it from the client list.
+        if connection not in self.clients:
+            return
+
+        self.clients.remove(connection)
+        self.metrics.closed(connection)
+        self.udp_tokens.pop(connection.udp_token, None)
+        self.udp_clients.pop(connection.udp_address, None)
+        connection.udp_address = None
+        self.selector.unregister(connection.socket)
+        connection.socket.close()
+
+        if resumable and connection.session is not None and connection.room is not None:
+            # The connection was lost, not closed by the player. Keep its seat in the room for a while,
+            # the lobby and match messages sent to it meanwhile are kept for when the client comes back.
+            self.keep_unsent(connection)
+            self.close_rings(connection)
+            connection.broken = True
+            connection.lost = time.monotonic()
+            log.info(f"keeping the seat of {connection.address} for {SESSION_GRACE} seconds")
+            return
+
+        self.close_rings(connection)
+        # However the client left, the other player can't carry on without it.
+        self.end_session(connection)
+
     def listen(self): 
-        #Listen for new connections.
-        self.serversocket.listen()
+        #Listen for new connections, or for connections handed over by the front process.
+        if self.handoff is None:
+            self.serversocket.listen()
+            self.serversocket.setblocking(False)
+            self.selector.register(self.serversocket, selectors.EVENT_READ)
+        else:
+            self.handoff.setblocking(False)
+            self.selector.register(self.handoff, selectors.EVENT_READ)
+        if self.udpsocket is not None:
+            self.selector.register(self.udpsocket, selectors.EVENT_READ)
+
+        next_tick = time.monotonic()
+        next_dump = time.monotonic() + self.stats_interval
+        next_ping = time.monotonic() + PING_INTERVAL
 
         while not self.shutdown_flag.is_set():
+            # Wake up regularly to check the shutdown flag, and in time for the next tick.
+            timeout = max(0, next_tick - time.monotonic()) if self.matches else 0.1
+            if self.shm_clients:
+                timeout = self.ring_timeout(timeout)
 
-            try:
+            for key, mask in self.selector.select(timeout=timeout):
+                try:
+                    self.handle_event(key, mask)
+                except Exception:
+                    # A bug in handling one connection must not stop every match on the server.
+                    if key.data is None or key.fileobj in (self.udpsocket, self.handoff):
+                        log.exception("error in the event loop")
+                    else:
+                        self.fail(key.data)
 
-                #Accept connection with socket.
-                conn, address = self.serversocket.accept() 
+            if self.shm_clients and self.poll_rings():
+                self.shm_active = time.monotonic()
 
-                #Add client socket information to list.
-                self.clients.append((conn, address))
+            # Run the simulation on a fixed timestep.
+            now = time.monotonic()
+            if not self.matches:
+                next_tick = now
+            else:
+                ticks = 0
+                while next_tick <= now and ticks < MAX_CATCH_UP:
+                    self.tick()
+                    next_tick += TICK
+                    ticks += 1
 
-                #Start a thread to monitor this connection.
-                threading.Thread(target=self.receive_and_respond, args=(conn, address)).start() 
+                if next_tick <= now:
+                    # Too far behind, skip the missed ticks instead of running them all.
+                    next_tick = now + TICK
 
-                '''
-                https://docs.python.org/3.10/library/socket.html#socket.socket.accept
-                conn is a new socket object usable to send and receive data on the connection,
-                address is the address bound to the socket on the other end of the connection.
-                '''
-            
-            except ConnectionAbortedError:
-                # Server socket is closed, dont accept any connections.
-                break
+            if now >= next_ping:
+                self.ping_clients()
+                self.close_idle(now)
+                self.expire_sessions(now)
+                next_ping = now + PING_INTERVAL
+
+            if self.stats_file and now >= next_dump:
+                self.dump_stats()
+                next_dump = now + self.stats_interval
 
-    def receive(self, clientsocket): 
+    def handle_event(self, key, mask):
+        connection = key.data
+
+        if key.fileobj is self.udpsocket:
+            self.receive_datagrams()
+            return
+
+        if key.fileobj is self.handoff:
+            self.adopt()
+            return
+
+        if connection is None:
+            # The server socket is readable, a client is connecting.
+            self.accept()
+            return
+
+        if mask & selectors.EVENT_WRITE:
+            self.flush(connection)
+
+        if mask & selectors.EVENT_READ:
+            #Receive every complete message that has arrived.
+            self.handle_frames(connection, self.receive(connection))
+
+    def fail(self, connection):
+        # Handling the connection raised an error, log it and close only this connection.
+        log.exception(f"error handling {connection.address}, closing the connection")
+        self.close(connection)
+
+    def handle_frames(self, connection, frames):
+        # Clock time the frames arrived, for the ping and pong replies.
+        received = time.time()
+        for frame in frames:
+            start = time.perf_counter()
+            message_type = frame_type(frame)
+            header = HEADERS[message_type][0] if message_type in HEADERS else "unknown"
+            self.metrics.received(connection, header, len(frame))
+
+            if message_type in RELAY_ONLY and connection.room is not None:
+                # Fast path: coordinates are forwarded as they arrived, without decoding them.
+                if len(frame) == RELAY_ONLY[message_type]:
+                    connection.room.positions[message_type] = frame
+                    self.send_to_other_client(connection, frame)
+            else:
+                try:
+                    header, payload = decode_frame(frame)
+                except ProtocolError:
+                    log.warning(f"undecodable message from {connection.address}")
+                    self.close(connection)
+                    return
+
+                self.respond(connection, header, payload, frame, received)
+
+            self.metrics.processed(header, time.perf_counter() - start)
+
+            if connection not in self.clients:
+                # The client disconnected, ignore anything it sent afterwards.
+                return
+
+    def ping_clients(self):
+        # Measure the round trip time to every client, they answer with a pong.
+        packet = self.serialise("ping", time.time())
+        for connection in self.clients:
+            self.send(connection, packet)
+
+    def close_idle(self, now: float):
+        # Disconnect clients that have stopped answering, their connection may never see an EOF.
+        for connection in list(self.clients):
+            if now - connection.last_received > IDLE_TIMEOUT:
+                log.info(f"{connection.address} timed out")
+                self.close(connection, resumable=True)
+
+    def dump_stats(self):
+        try:
+            self.metrics.dump(self, self.stats_file)
+        except OSError as error:
+            log.warning(f"could not write stats file: {error}")
+
+    def receive(self, connection): 
         try:
-            # Receive a maximum of 1024 bytes
-            packet = clientsocket.recv(1024)
+            # Receive a maximum of 4096 bytes
+            data = connection.socket.recv(4096)
+
+            if not data:
+                # The client closed the connection.
+                log.info(f"{connection.address} closed the connection")
+                self.close(connection, resumable=True)
+                return []
+
+            connection.last_received = time.monotonic()
+
+            # Split the bytes into frames, several may have been merged by TCP.
+            frames = connection.decoder.split(data)
+
+        except BlockingIOError:
+            return []
         
-        except ConnectionResetError:
-            return None
+        except (OSError, ProtocolError) as error:
+            # Connection reset or timed out, or the stream can't be decoded.
+            log.info(f"{connection.address} connection lost")
+            self.close(connection, resumable=not isinstance(error, ProtocolError))
+            return []
 
         else:
-            return packet
+            return frames
+
+def main():
+    parser = argparse.ArgumentParser(description="Pacman relay server")
+    parser.add_argument("--host", default=None, help="address to bind, defaults to this machine's network address")
+    parser.add_argument("--port", type=int, default=0, help="port to bind, defaults to a free port")
+    parser.add_argument("--headless", action="store_true", help="run without the information window")
+    parser.add_argument("--authoritative", action="store_true", help="run the game on the server, clients only send input")
+    parser.add_argument("--stats-file", default=None, help="save counters and latency histograms to this JSON file")
+    parser.add_argument("--stats-interval", type=float, default=5, help="seconds between saves of the stats file")
+    parser.add_argument("--no-shared-memory", action="store_true", help="use TCP for clients on this machine too")
+    parser.add_argument("--workers", type=int, default=1, help="spread the rooms over this many processes, always headless")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        if not hasattr(socket, "send_fds"):
+            parser.error("--workers needs Python 3.9 or newer on a Unix system")
+
+        logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                            format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+
+        # The front process hands each room's connections to one of the workers.
+        from version_3_shards import Front
+        Front(args.host, args.port, args.workers, args.authoritative, args.stats_file, args.stats_interval,
+              not args.no_shared_memory)
+        return
+
+    # Log to stdout, the information window is optional.
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    Server(args.host, args.port, args.headless, args.authoritative, args.stats_file, args.stats_interval,
+           not args.no_shared_memory)
 
-server = Server()
 
+if __name__ == "__main__":
+    main()
\ No newline at end of file
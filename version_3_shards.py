@@ -0,0 +1,214 @@
+import logging
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import sys
+import time
+import zlib
+from version_3_protocol import Decoder, ProtocolError, decode_frame, encode
+from version_3_server import DEFAULT_ROOM, Server, find_ip, session_room
+
+'''
+Runs the server as one front process and several worker processes, so rooms are spread over the CPU cores.
+
+The front process accepts every TCP connection and reads its first messages. As soon as the client
+says which room it wants, the connection is handed to the worker that owns that room, along with
+the bytes read so far. The socket itself is passed over a Unix socket pair, so the worker talks to
+the client directly and the front process is no longer involved.
+
+    client          front                   worker
+    "join-room" --> room -> worker
+                    socket + bytes  ----->  handles the connection from then on
+
+Each room always goes to the same worker, so the lobby and the match only exist in one process.
+A resumed session names its room in the token, so it goes back to the worker that kept the seat.
+'''
+
+log = logging.getLogger("server")
+
+# Bytes the front process keeps for a client that hasn't picked a room yet.
+MAX_PENDING = 4096
+
+# Messages that are kept for the worker while the front process waits for the room.
+HELD = {"udp-request", "shm-request"}
+
+
+def worker_for(room_id: str, workers: int):
+    # Every process picks the same worker for a room.
+    return zlib.crc32(room_id.encode("utf-8")) % workers
+
+
+def run_worker(ip, port, channel, authoritative, stats_file, stats_interval, shared_memory):
+    # Ctrl+C reaches every process, the workers stop when the front process closes their channel instead.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Only needed when the process doesn't inherit the front process's logging.
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO,
+                        format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+    Server(ip, port, True, authoritative, stats_file, stats_interval, shared_memory, handoff=channel)
+
+
+class Pending(object):
+    # A connection the front process has accepted but not handed over yet.
+    def __init__(self, conn, address):
+        self.socket = conn
+        self.address = address
+        self.decoder = Decoder()
+        # Frames to pass on to the worker.
+        self.held = []
+
+
+class Front(object):
+    def __init__(self, ip=None, port=0, workers=2, authoritative=False, stats_file=None, stats_interval=5,
+                 shared_memory=True):
+        if ip is None:
+            ip = find_ip()
+
+        self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.serversocket.bind((ip, port))
+        self.ip = ip
+        self.port = self.serversocket.getsockname()[1]
+
+        # One socket pair and process per worker. Spawned workers don't inherit the front's sockets,
+        # so a worker sees its channel close when the front process stops.
+        context = multiprocessing.get_context("spawn")
+        self.channels = []
+        self.workers = []
+        for index in range(workers):
+            channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            worker_stats = None
+            if stats_file is not None:
+                # Each worker saves its own stats: stats.json -> stats-0.json, stats-1.json ...
+                name, extension = os.path.splitext(stats_file)
+                worker_stats = f"{name}-{index}{extension}"
+            process = context.Process(
+                target=run_worker, name=f"worker-{index}",
+                args=(ip, self.port, worker_channel, authoritative, worker_stats, stats_interval, shared_memory))
+            process.start()
+            worker_channel.close()
+
+            self.channels.append(channel)
+            self.workers.append(process)
+
+        self.pending = {}
+        self.selector = selectors.DefaultSelector()
+
+        log.info(f"listening on {self.ip}:{self.port} with {workers} workers")
+
+        try:
+            self.listen()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.exit()
+
+    def exit(self):
+        # A second Ctrl+C would leave the workers running.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        for pending in list(self.pending.values()):
+            pending.socket.close()
+        self.selector.close()
+        self.serversocket.close()
+
+        # The workers stop once their channel closes.
+        for channel in self.channels:
+            channel.close()
+        for process in self.workers:
+            process.join()
+
+        log.info("server closed")
+
+    def listen(self):
+        self.serversocket.listen()
+        self.serversocket.setblocking(False)
+        self.selector.register(self.serversocket, selectors.EVENT_READ)
+
+        while True:
+            for key, mask in self.selector.select():
+                if key.fileobj is self.serversocket:
+                    self.accept()
+                else:
+                    self.receive(key.data)
+
+    def accept(self):
+        try:
+            conn, address = self.serversocket.accept()
+        except BlockingIOError:
+            return
+
+        conn.setblocking(False)
+        pending = Pending(conn, address)
+        self.pending[conn] = pending
+        self.selector.register(conn, selectors.EVENT_READ, pending)
+
+    def drop(self, pending):
+        self.selector.unregister(pending.socket)
+        del self.pending[pending.socket]
+        pending.socket.close()
+
+    def receive(self, pending):
+        try:
+            data = pending.socket.recv(4096)
+            if not data:
+                self.drop(pending)
+                return
+            frames = pending.decoder.split(data)
+        except BlockingIOError:
+            return
+        except (OSError, ProtocolError):
+            self.drop(pending)
+            return
+
+        for index, frame in enumerate(frames):
+            try:
+                header, payload = decode_frame(frame)
+            except ProtocolError:
+                self.drop(pending)
+                return
+
+            if header == "ping":
+                # Answer for the worker, the client may sit on the room page for a while.
+                now = time.time()
+                try:
+                    pending.socket.send(encode("pong", (payload, now, now)))
+                except OSError:
+                    pass
+            elif header == "pong":
+                pass
+            elif header == "disconnect":
+                # The client left before joining a room, no worker needs to know.
+                self.drop(pending)
+                return
+            elif header in HELD:
+                pending.held.append(bytes(frame))
+            else:
+                if header == "join-room":
+                    room_id = payload
+                elif header == "resume-session":
+                    room_id = session_room(payload)
+                else:
+                    room_id = DEFAULT_ROOM
+                self.hand_over(pending, room_id, b"".join(frames[index:]))
+                return
+
+        if sum(len(frame) for frame in pending.held) > MAX_PENDING:
+            log.warning(f"{pending.address} sent too much before joining a room")
+            self.drop(pending)
+
+    def hand_over(self, pending, room_id: str, frames: bytes):
+        # Pass the socket and everything read from it to the worker that owns the room.
+        data = b"".join(pending.held) + frames + pending.decoder.buffer
+        channel = self.channels[worker_for(room_id, len(self.channels))]
+
+        self.selector.unregister(pending.socket)
+        del self.pending[pending.socket]
+        try:
+            socket.send_fds(channel, [data], [pending.socket.fileno()])
+        except OSError as error:
+            log.warning(f"could not hand {pending.address} to a worker: {error}")
+
+        # The worker has its own copy of the socket now.
+        pending.socket.close()
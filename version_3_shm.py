@@ -0,0 +1,143 @@
+import os
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+'''
+Shared memory transport for a client running on the same machine as the server.
+
+The server creates two ring buffers for the client, one for each direction. The frames are
+the same as on TCP, they are copied into the ring by one process and out of it by the other,
+without going through the network stack. The TCP connection stays open, to negotiate the
+rings and so either side notices when the other one goes away.
+
+    client                          server
+    "shm-request"   --- TCP -->                     The server is on the same machine
+                    <-- TCP ---     "shm-offer"     Name of the two rings
+    "shm-attached"  --- TCP -->                     Last message the client sends over TCP
+                    <-- TCP ---     "shm-switched"  Last message the server sends over TCP
+
+Each ring has one writer and one reader. The writer only changes the written counter and the
+reader only changes the read counter, so neither needs a lock.
+
+While messages are arriving the reader keeps checking its ring, which costs no system calls.
+Once it has been quiet for a moment the reader sets the ring's waiting flag and sleeps until
+something arrives on the TCP connection. A writer that finds the flag set clears it and sends
+"shm-wake" over TCP to wake the reader up.
+'''
+
+# Bytes of frames each ring can hold.
+RING_SIZE = 256 * 1024
+
+# Seconds the reader keeps checking its ring after a message, when the next one is likely to follow soon.
+SPIN_TIME = 0.002
+# Longest sleep of a waiting reader, in case a wake up was missed.
+WAIT_TIMEOUT = 0.01
+
+# The rings are only quicker than loopback TCP when the reader can check them on one CPU
+# while the writer runs on another. With a single CPU the checking holds up the writer.
+WORTHWHILE = (os.cpu_count() or 1) > 1
+
+# Start of the shared memory block: capacity, bytes written, bytes read, reader waiting flag.
+COUNTERS = struct.Struct("=QQQQ")
+WRITTEN = 8
+READ = 16
+WAITING = 24
+COUNTER = struct.Struct("=Q")
+
+
+def same_machine(sock):
+    # Returns True if both ends of a connected socket are on this machine.
+    try:
+        return sock.getsockname()[0] == sock.getpeername()[0]
+    except OSError:
+        return False
+
+
+def attach(name: str):
+    # Opens a shared memory block created by another process.
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Before Python 3.13 the resource tracker deletes the block when this process exits,
+        # even though the server created it.
+        memory = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(memory._name, "shared_memory")
+        return memory
+
+
+class RingBuffer(object):
+    '''
+    A byte pipe between two processes in a shared memory block.
+    Frames are written whole, so the reader never sees part of a frame.
+    '''
+    def __init__(self, name: str, create=False, size=RING_SIZE):
+        self.owner = create
+        if create:
+            self.memory = shared_memory.SharedMemory(name, create=True, size=COUNTERS.size + size)
+            COUNTERS.pack_into(self.memory.buf, 0, size, 0, 0, 0)
+        else:
+            self.memory = attach(name)
+
+        self.name = name
+        self.capacity = COUNTERS.unpack_from(self.memory.buf)[0]
+
+    def write(self, data):
+        # Copies the data into the ring. Returns False, without writing anything, if there isn't room.
+        buf = self.memory.buf
+        written = COUNTER.unpack_from(buf, WRITTEN)[0]
+        read = COUNTER.unpack_from(buf, READ)[0]
+
+        size = len(data)
+        if self.capacity - (written - read) < size:
+            return False
+
+        # The data may wrap around the end of the ring.
+        start = written % self.capacity
+        first = min(size, self.capacity - start)
+        buf[COUNTERS.size + start:COUNTERS.size + start + first] = data[:first]
+        if first < size:
+            buf[COUNTERS.size:COUNTERS.size + size - first] = data[first:]
+
+        # Publish the data only once it has all been copied.
+        COUNTER.pack_into(buf, WRITTEN, written + size)
+        return True
+
+    def read(self):
+        # Returns every byte written since the last read, or b"" if there are none.
+        buf = self.memory.buf
+        written = COUNTER.unpack_from(buf, WRITTEN)[0]
+        read = COUNTER.unpack_from(buf, READ)[0]
+
+        size = written - read
+        if not size:
+            return b""
+
+        start = read % self.capacity
+        first = min(size, self.capacity - start)
+        data = bytes(buf[COUNTERS.size + start:COUNTERS.size + start + first])
+        if first < size:
+            data += bytes(buf[COUNTERS.size:COUNTERS.size + size - first])
+
+        # Give the space back to the writer.
+        COUNTER.pack_into(buf, READ, written)
+        return data
+
+    def available(self):
+        # Returns the number of bytes waiting to be read.
+        return COUNTER.unpack_from(self.memory.buf, WRITTEN)[0] - COUNTER.unpack_from(self.memory.buf, READ)[0]
+
+    def set_waiting(self, waiting: bool):
+        # Set by the reader before it sleeps, cleared by whoever wakes it.
+        COUNTER.pack_into(self.memory.buf, WAITING, int(waiting))
+
+    def is_waiting(self):
+        return COUNTER.unpack_from(self.memory.buf, WAITING)[0] == 1
+
+    def close(self):
+        self.memory.close()
+        if self.owner:
+            # The block is removed once both processes have closed it.
+            try:
+                self.memory.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,249 @@
+'''
+Headless game simulation, used by the server in authoritative mode.
+
+It follows the same rules as the sprites in version_3.py, without needing Pygame:
+the maze, the movement of both players, pellets, victory and the game over check.
+Rects are (x, y, width, height) tuples in pixels.
+'''
+import os
+import version_3_maze
+
+# Game constants (pixels), shared by the client and the server.
+DIMENSIONS = (510, 500)                                         # Dimensions of the game window
+SIZE = 30                                                       # Length of each grid
+PELLET_SIZE = 10                                                # Length of each pellet
+SPEED = 2                                                       # Pixels a player moves each frame
+
+# Maze files, found next to this file so the server can be started from any folder.
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+MAZES = [os.path.join(FOLDER, name) for name in ("maze1.txt", "maze2.txt", "maze3.txt")]
+
+# Input bits, one for each arrow key. Checked in the same order as the client's arrow keys.
+LEFT = 1
+RIGHT = 2
+UP = 4
+DOWN = 8
+
+DIRECTIONS = {
+    LEFT: (-SPEED, 0),
+    RIGHT: (SPEED, 0),
+    UP: (0, -SPEED),
+    DOWN: (0, SPEED),
+}
+
+
+def colliding(a, b):
+    # Returns True if two rects overlap, like pygame.Rect.colliderect.
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+class TileGrid(object):
+    '''
+    One byte for each tile of a maze, set where the tile holds something.
+    A rect only has to be checked against the few tiles it overlaps, however big the maze is.
+    '''
+    def __init__(self, columns=0, rows=0, tiles=b""):
+        self.columns = columns
+        self.rows = rows
+        self.tiles = tiles
+
+    def overlapped(self, rect):
+        # Returns the (first column, last column, first row, last row) of the tiles a rect overlaps, or None.
+        # Tiles outside the maze are left out, they are always empty, like the tunnels at the edges.
+        x, y, width, height = rect
+        if width <= 0 or height <= 0:
+            return None
+
+        first_col = max(x // SIZE, 0)
+        last_col = min((x + width - 1) // SIZE, self.columns - 1)
+        first_row = max(y // SIZE, 0)
+        last_row = min((y + height - 1) // SIZE, self.rows - 1)
+        if first_col > last_col or first_row > last_row:
+            return None
+
+        return first_col, last_col, first_row, last_row
+
+
+class WallGrid(TileGrid):
+    '''
+    The walls of a maze. They never change, so the tiles are the compiled maze's own bytes.
+    '''
+    def __init__(self, maze=None):
+        if maze is None:
+            super().__init__()
+        else:
+            super().__init__(maze.columns, maze.rows, maze.walls)
+
+    def collides(self, rect):
+        # Returns True if a rect overlaps a wall, like colliding() with every wall rect.
+        tiles = self.overlapped(rect)
+        if tiles is None:
+            return False
+
+        first_col, last_col, first_row, last_row = tiles
+        for row in range(first_row, last_row + 1):
+            start = row * self.columns
+            if any(self.tiles[start + first_col:start + last_col + 1]):
+                return True
+        return False
+
+
+class PelletGrid(TileGrid):
+    '''
+    The pellets left in a maze, at most one in the middle of each tile.
+    '''
+    def __init__(self, maze=None):
+        if maze is None:
+            super().__init__()
+            self.remaining = 0
+        else:
+            # Pellets are eaten, so each game gets its own copy of the tiles.
+            super().__init__(maze.columns, maze.rows, bytearray(maze.pellets))
+            self.remaining = maze.pellet_count
+
+    def eat(self, rect, eaten_rects=None):
+        # Removes the pellets a rect overlaps, like colliding() with every pellet rect. Returns how many there were.
+        # The rects of the eaten pellets are added to eaten_rects if it is given.
+        tiles = self.overlapped(rect)
+        if tiles is None:
+            return 0
+
+        eaten = 0
+        first_col, last_col, first_row, last_row = tiles
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                index = row * self.columns + col
+                if self.tiles[index] and colliding(rect, self.pellet_rect(col, row)):
+                    self.tiles[index] = 0
+                    eaten += 1
+                    if eaten_rects is not None:
+                        eaten_rects.append(self.pellet_rect(col, row))
+
+        self.remaining -= eaten
+        return eaten
+
+    def pellet_rect(self, col: int, row: int):
+        return (col*SIZE+PELLET_SIZE, row*SIZE+PELLET_SIZE, PELLET_SIZE, PELLET_SIZE)
+
+    def positions(self, rect=None):
+        # Returns the top left corner of every pellet left, or only those in the tiles a rect overlaps, to draw them.
+        if rect is not None:
+            tiles = self.overlapped(rect)
+            if tiles is None:
+                return []
+
+            first_col, last_col, first_row, last_row = tiles
+            return [(col*SIZE+PELLET_SIZE, row*SIZE+PELLET_SIZE)
+                    for row in range(first_row, last_row + 1) for col in range(first_col, last_col + 1)
+                    if self.tiles[row * self.columns + col]]
+
+        positions = []
+        index = self.tiles.find(1)
+        while index != -1:
+            row, col = divmod(index, self.columns)
+            positions.append((col*SIZE+PELLET_SIZE, row*SIZE+PELLET_SIZE))
+            index = self.tiles.find(1, index + 1)
+        return positions
+
+
+def load_maze(filename):
+    # Returns the CompiledMaze, WallGrid and PelletGrid of a maze file.
+    maze = version_3_maze.load(filename)
+    return maze, WallGrid(maze), PelletGrid(maze)
+
+
+def spawn_point(tile: tuple):
+    # Returns the top left corner, in pixels, of a spawn tile.
+    return (tile[0] * SIZE, tile[1] * SIZE)
+
+
+class Player(object):
+    def __init__(self, spawn: tuple):
+        self.spawn = spawn
+        self.x, self.y = spawn
+        # Bitmask of the arrow keys the player is holding.
+        self.keys = 0
+        self.last_direction = None
+
+    def rect(self):
+        return (self.x, self.y, SIZE, SIZE)
+
+    def move_to_spawn(self):
+        self.x, self.y = self.spawn
+        self.last_direction = None
+
+    def __can_move(self, direction, walls):
+        dx, dy = DIRECTIONS[direction]
+        new_position = (self.x + dx, self.y + dy, SIZE, SIZE)
+        return not walls.collides(new_position)
+
+    def __move(self, walls):
+        for direction in DIRECTIONS:
+            if self.keys & direction and self.__can_move(direction, walls):
+                # Arrow key is pressed and there is no wall in the way.
+                self.x += DIRECTIONS[direction][0]
+                self.y += DIRECTIONS[direction][1]
+                self.last_direction = direction
+                return
+
+        # Keep moving in the last direction.
+        if self.last_direction and self.__can_move(self.last_direction, walls):
+            self.x += DIRECTIONS[self.last_direction][0]
+            self.y += DIRECTIONS[self.last_direction][1]
+
+    def __check_for_teleport(self):
+        x_min = SIZE
+        x_max = DIMENSIONS[0] - SIZE
+
+        if self.x < x_min:
+            self.x = x_max
+        elif self.x > x_max:
+            self.x = x_min
+
+    def step(self, walls):
+        self.__move(walls)
+        self.__check_for_teleport()
+
+
+class Match(object):
+    '''
+    One match between a Pacman and a Ghost, advanced one fixed tick at a time.
+    '''
+    def __init__(self, maze_number=0):
+        self.tick = 0
+        self.score = 0
+        self.load_maze(maze_number)
+        self.pacman = Player(spawn_point(self.maze.pacman_spawn))
+        self.ghost = Player(spawn_point(self.maze.ghost_spawn))
+
+    def load_maze(self, maze_number):
+        self.maze_number = maze_number
+        self.maze, self.walls, self.pellets = load_maze(MAZES[maze_number])
+
+    def step(self):
+        # Advances the match by one tick. Returns True when the Ghost has eaten Pacman.
+        self.tick += 1
+
+        self.pacman.step(self.walls)
+        self.ghost.step(self.walls)
+
+        # Eat the pellets Pacman is touching.
+        pacman = self.pacman.rect()
+        self.score += self.pellets.eat(pacman)
+
+        if colliding(pacman, self.ghost.rect()):
+            return True
+
+        if not self.pellets.remaining:
+            # Victory, load the next maze and start again from its spawn points.
+            self.load_maze((self.maze_number + 1) % len(MAZES))
+            self.pacman.spawn = spawn_point(self.maze.pacman_spawn)
+            self.ghost.spawn = spawn_point(self.maze.ghost_spawn)
+            self.pacman.move_to_spawn()
+            self.ghost.move_to_spawn()
+
+        return False
+
+    def snapshot(self):
+        # Returns the state the clients need to draw the match.
+        return (self.tick, self.maze_number, self.pacman.x, self.pacman.y, self.ghost.x, self.ghost.y, self.score)
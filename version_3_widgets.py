@@ -18,6 +18,13 @@ class Text():
         self.x, self.y, self.size, self.background_colour = x, y, size, background_color
         self.text = text
         self.font = pygame.font.SysFont(FONT, size)
+        self.rect = pygame.Rect(x, y, 0, 0)
+        # Text and colour the widget was last drawn with.
+        self.drawn = None
+
+    def changed(self):
+        # Returns True if the widget would look different from when it was last drawn.
+        return self.drawn != (self.text, self.background_colour)
     
     def update(self, target_surface):
         self.text_surface = self.font.render(self.text, True, YELLOW)
@@ -29,6 +36,7 @@ class Text():
         target_surface.blit(self.background, (self.x, self.y))
         # Blit the text on top of the background on the surface.
         target_surface.blit(self.text_surface, (self.x, self.y))
+        self.drawn = (self.text, self.background_colour)
 
 
 class Button(Text):
@@ -63,13 +71,34 @@ class Input(Text):
 
 class Page():
     current_page = 0
+    drawn_page = None                                           # The page on the screen
     def __init__(self):
         self.widgets = []
     
     def update(self, target_surface):
-        target_surface.fill(BACKGROUND_COLOR)
+        # Draws the page and returns the rects of the screen that changed.
+        if Page.drawn_page is not self:
+            # The page has just been shown, draw all of it.
+            Page.drawn_page = self
+            self.draw_background(target_surface)
+            for widget in self.widgets:
+                widget.update(target_surface)
+            return [target_surface.get_rect()]
+
+        # Only redraw the widgets that changed, a page with no changes draws nothing.
+        dirty = []
         for widget in self.widgets:
-            widget.update(target_surface)
+            if widget.changed():
+                # Cover the old widget, it may have been bigger.
+                old_rect = widget.rect
+                self.draw_background(target_surface, old_rect)
+                widget.update(target_surface)
+                dirty.append(old_rect.union(widget.rect))
+        return dirty
+
+    def draw_background(self, target_surface, rect=None):
+        # Fills the rect, or the whole surface if no rect is given, with the page's background.
+        target_surface.fill(BACKGROUND_COLOR, rect)
 
     def next_page(self):
         Page.current_page += 1